@@ -1,16 +1,28 @@
 from dataclasses import Field
+import asyncio
+import dataclasses
+import inspect
 import json
 import logging
-import sqlite3
-import subprocess
-import sys
+import threading
 from typing import Dict
 import uuid
-from openai import OpenAI
-import tempfile
 import os
-import shutil
 import re
+from cache import (CachingClient, CompletionCache, ExecutionCache, get_default_cache, get_default_execution_cache,
+                   is_deterministic)
+from clients import get_async_client, get_client
+from context import ContextManager
+from dispatch import ToolDispatcher
+from lessons import LessonExtractor, get_lesson_index
+from packages import PackageResolver, get_default_resolver, requirements_for, suggested_requirements
+from persistence import HistoryStore, get_store
+import runner
+from runner import ExecutionLimits, ExecutionResult
+from sandbox import SandboxPool, get_default_pool
+from streaming import StreamAssembler
+from tracing import get_tracer
+from worker import InterpreterWorker
 
 exit_tool = {
     "type": "function",
@@ -76,19 +88,63 @@ python_interpreter_tool = {
 
 
 class Agent:
-    def __init__(self, prompt: str, instance_id=None, tools: list[dict] = []):
-        self.db_connection = sqlite3.connect('conversation_history.db')
+    lesson_top_k = 10  # most lessons injected into the system prompt
+    lesson_token_budget = 1000  # most tokens of lessons injected into the system prompt
+
+    def __init__(self, prompt: str, instance_id=None, tools: list[dict] = [], store: HistoryStore = None, task: str = None,
+                 cache: CompletionCache = None, context_manager: ContextManager = None):
+        # All agents in the process share one connection and write-behind queue
+        self.store = store or get_store()
+        self.db_connection = self.store.connection
         self.agent_type = self.__class__.__name__  # Store the agent type
-        self._initialize_db()
 
         self.tools = [exit_tool] + tools
+        # Bounds the prompt sent on each turn; the settings are per agent type
+        self.context_manager = context_manager or ContextManager.for_agent_type(self.agent_type)
+        self.last_message_id = 0  # id of the last stored message loaded into conversation_history
+
+        # The history (stored messages, or a prompt with selected lessons) is only built on first use
+        self.instance_id = instance_id or str(uuid.uuid4())
+        self._resume = bool(instance_id)
+        self._prompt = prompt
+        self._task = task
+        self._conversation_history = None
+        self._history_lock = threading.Lock()
+
+        # Completions go through the process-wide clients, behind the response cache when one is configured
+        self.cache = cache or get_default_cache()
+        self._openai = None
+        # Called with the conversation after each user reply, e.g. to prepare the next agent in the background
+        self.turn_hooks = []
+        self.logger = logging.getLogger(f"{str(self.instance_id)} - {__name__}")
+        self.logger.info(f"created agent with instance_id: {str(self.instance_id)}")
 
-        if instance_id:
-            self.instance_id = instance_id
-            self.conversation_history = self._load_conversation_history()
+    @property
+    def conversation_history(self) -> list[dict]:
+        if self._conversation_history is None:
+            # The history may be prepared on a background thread while the agent starts running
+            with self._history_lock:
+                if self._conversation_history is None:
+                    self._build_history()
+        return self._conversation_history
+
+    def _build_history(self):
+        history = []
+        if self._resume:
+            self._load_conversation_history(history)
         else:
-            self.instance_id = str(uuid.uuid4())  # Generate a new unique ID
-            prompt = prompt + """
+            history.append({"role": "system", "content": self._system_prompt()})
+        # Full tool lists and prompts are only built when debug logging is on
+        self.logger.debug("tools: %s", self.tools)
+        self.logger.debug("prompt: %s", history[0]["content"] if history else None)
+        self._conversation_history = history
+
+    def load_history(self) -> list[dict]:
+        """Builds the history now instead of on first use"""
+        return self.conversation_history
+
+    def _system_prompt(self) -> str:
+        prompt = self._prompt + """
 Consider lessons learned from previous interactions to enhance your approach. 
 Integrate these insights into your chain of thought and responses to better serve the user.
 
@@ -98,58 +154,75 @@ Lessons learned:
 Consider the following tools: 
 {tools}
             """
-            final_prompt = prompt.format(
-                lessons="\n".join(self.load_learned_lessons()), 
-                tools="\n".join([f"{tool['function']['name']}: {tool['function']['description']}" for tool in self.tools])
-            )
-            self.conversation_history = [
-                {"role": "system", "content": final_prompt}
-            ]
-        
-        self.openai = OpenAI()
-        self.logger = logging.getLogger(f"{str(self.instance_id)} - {__name__}")
-        self.logger.info(f"created agent with instance_id: {str(self.instance_id)}")
-        self.logger.info(f"tools: {self.tools}")
-        self.logger.info(f"prompt: {final_prompt}")
-
-    def _initialize_db(self):
-        with self.db_connection:
-            self.db_connection.execute('''
-                CREATE TABLE IF NOT EXISTS conversation_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    instance_id TEXT NOT NULL,
-                    agent_type TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL
-                )
-            ''')
-            self.db_connection.execute('''
-                CREATE TABLE IF NOT EXISTS lessons_learned (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    agent_type TEXT NOT NULL,
-                    lesson TEXT NOT NULL
-                )
-            ''')
+        return prompt.format(
+            lessons="\n".join(self.select_lessons(self._task or self._prompt)), 
+            tools="\n".join([f"{tool['function']['name']}: {tool['function']['description']}" for tool in self.tools])
+        )
+
+    def _client(self, asynchronous: bool = False):
+        if self.cache is not None and self.cache.mode == "replay":
+            return CachingClient(None, self.cache, asynchronous=asynchronous)
+        client = get_async_client() if asynchronous else get_client()
+        return client if self.cache is None else CachingClient(client, self.cache)
 
-    def _load_conversation_history(self):
-        cursor = self.db_connection.cursor()
-        cursor.execute('''
-            SELECT role, content FROM conversation_history WHERE instance_id = ?
-        ''', (self.instance_id,))
-        rows = cursor.fetchall()
-        return [{"role": row[0], "content": row[1]} for row in rows]
+    @property
+    def openai(self):
+        if self._openai is None:
+            self._openai = self._client()
+        return self._openai
+
+    @property
+    def aopenai(self):
+        # Async clients belong to one event loop, so the lookup is done on every use
+        return self._client(asynchronous=True)
+
+    def _load_conversation_history(self, history: list[dict] = None):
+        """Appends the stored messages after last_message_id, so a session resumes where it left off"""
+        history = self.conversation_history if history is None else history
+        for message_id, role, content in self.store.iter_history(self.instance_id, after_id=self.last_message_id):
+            history.append({"role": role, "content": content})
+            self.last_message_id = message_id
+        return history
 
 
     def add_message_to_history(self, role: str, content: str):
         # Add message to conversation history
-        self.logger.info(f"adding message to history: {role}, {content}")
+        self.logger.debug("adding message to history: %s, %s", role, content)
         self.conversation_history.append({"role": role, "content": content})
         
-        # Insert message into SQLite database with instance_id and agent_type
-        with self.db_connection:
-            self.db_connection.execute('''
-                INSERT INTO conversation_history (instance_id, agent_type, role, content) VALUES (?, ?, ?, ?)
-            ''', (self.instance_id, self.agent_type, role, content))
+        # Queue the message for the store's batched write with instance_id and agent_type
+        self.store.append(self.instance_id, self.agent_type, role, content)
+
+    def _notify_turn(self):
+        for hook in self.turn_hooks:
+            try:
+                hook(self.conversation_history)
+            except Exception as e:
+                self.logger.warning(f"turn hook failed: {e}")
+
+    async def aadd_message_to_history(self, role: str, content: str):
+        """Async variant of add_message_to_history; queuing never touches the disk, so it does not block the loop"""
+        self.add_message_to_history(role, content)
+
+    def close(self):
+        """Ends the session: makes sure every message of this agent has been written"""
+        self.store.flush()
+
+    def _complete(self, create, **params):
+        """Calls a completion method, tracing its latency and token counts"""
+        tracer = get_tracer()
+        with tracer.span("completion", self.instance_id, agent_type=self.agent_type, model=params.get("model")) as span:
+            response = create(**params)
+            tracer.record_completion(span, getattr(response, "usage", None), self.agent_type)
+        return response
+
+    async def _acomplete(self, create, **params):
+        """Async variant of _complete"""
+        tracer = get_tracer()
+        with tracer.span("completion", self.instance_id, agent_type=self.agent_type, model=params.get("model")) as span:
+            response = await create(**params)
+            tracer.record_completion(span, getattr(response, "usage", None), self.agent_type)
+        return response
 
     def extract_lessons_from_messages(self, messages):
         prompt = """
@@ -159,51 +232,45 @@ Consider the following tools:
         Extract the lessons from the following conversation:
         {messages}  
         """
-        response = self.openai.chat.completions.create(
+        response = self._complete(
+            self.openai.chat.completions.create,
             model="gpt-4o",
             messages=[{"role": "system", "content": prompt.format(messages="\n".join(messages))}],
+            temperature=0.0
         )
         return response.choices[0].message.content
 
-    def extract_lessons_learned(self):
-        with self.db_connection:
-            cursor = self.db_connection.execute('''
-                SELECT content FROM conversation_history
-                WHERE agent_type = ?
-            ''', (self.agent_type,))
-            messages = [row[0] for row in cursor.fetchall()]
-
-        # Use OpenAI to extract lessons learned
-        lessons = self.extract_lessons_from_messages(messages)
+    def extract_lessons_learned(self, token_budget: int = 6000, max_workers: int = 4, query: str = None):
+        # Use OpenAI to extract lessons from the sessions recorded since the last extraction,
+        # or only from the past sessions matching `query`
+        lessons = LessonExtractor(self, token_budget=token_budget, max_workers=max_workers, query=query).extract()
         self.logger.info(f"extracted lessons for agent {self.agent_type}: {lessons}")
-        
-        # Save lessons to the database
-        with self.db_connection:
-            self.db_connection.execute('''
-                INSERT INTO lessons_learned (agent_type, lesson)
-                    VALUES (?, ?)
-                ''', (self.agent_type, lessons))
+        return lessons
 
     def run(self, input):
         pass
 
+    async def arun(self, input, context: dict = None):
+        """Runs the agent without blocking the event loop; subclasses override with a native version"""
+        return await asyncio.to_thread(self.run, input, context)
+
+    def select_lessons(self, query: str = "") -> list[str]:
+        """Picks the stored lessons most relevant to the query that fit in the lesson token budget"""
+        return get_lesson_index(self.store, self.agent_type).select(query, k=self.lesson_top_k, token_budget=self.lesson_token_budget)
+
     def load_learned_lessons(self) -> list[str]:
         """Load learned lessons for the current agent type."""
-        with self.db_connection:
-            cursor = self.db_connection.execute('''
-                SELECT lesson FROM lessons_learned
-                WHERE agent_type = ?
-            ''', (self.agent_type,))
-            lessons = [row[0] for row in cursor.fetchall()]
-
-        return lessons
+        return self.store.lessons(self.agent_type)
 
 
 
 
 class Coder(Agent):
 
-    def __init__(self, prompt: str =None, instance_id=None):
+    def __init__(self, prompt: str =None, instance_id=None, pool: SandboxPool = None, resolver: PackageResolver = None,
+                 execution_mode: str = "process", persistent_namespace: bool = False, timeout: float = 60.0,
+                 memory_limit: int = None, task: str = None, max_parallel_tools: int = 4,
+                 cpu_limit: float = None, output_limit: int = 32768, execution_cache: ExecutionCache = None):
         # prompt = ("You are an AI capable of generating and running Python code to solve user questions. "
         #         "Use a chain-of-thought approach to produce code step-by-step, analyzing results after each execution."
         #         "When you believe you have a working solution, execute the code using the appropriate tool."
@@ -224,52 +291,260 @@ class Coder(Agent):
         Return only the Python code snippets intended for execution. Ensure that the final script prints the solution clearly on standard output, 
         fulfilling all requirements accurately and completely.
         """
-        super().__init__(prompt=prompt, instance_id=instance_id, tools=[python_interpreter_tool])
-        self.execution_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
-        
-        # Set up a virtual environment in the execution directory
-        subprocess.run([sys.executable, "-m", "venv", self.execution_dir])
+        super().__init__(prompt=prompt, instance_id=instance_id, tools=[python_interpreter_tool], task=task)
+
+        # A pre-warmed virtual environment is leased from the pool on first use, not per construction
+        self.pool = pool or get_default_pool()
+        self._sandbox = None
+        self._lease_lock = threading.RLock()
+        self._closed = False
+        # Background prepare calls in progress; a release requested meanwhile is left to the last of them
+        self._preparing = 0
+        self._release_pending = False
+        # Results of identical deterministic snippets are reused when an execution cache is configured
+        self.execution_cache = execution_cache or get_default_execution_cache()
+        self.resolver = resolver or get_default_resolver()
+        self._install_lock = threading.Lock()
+        self.timeout = timeout
+        # Wall-clock, CPU and memory limits and the output kept per snippet, shared by both execution modes
+        self.limits = ExecutionLimits(timeout=timeout, cpu_seconds=cpu_limit, memory_bytes=memory_limit, output_bytes=output_limit)
+
+        # Several execute_code calls in one turn run concurrently, each in its own working dir
+        self.max_parallel_tools = max_parallel_tools
+        self._dispatcher = None
+        self._worker_lock = threading.Lock()
+
+        # "process" starts a fresh interpreter per snippet, "worker" keeps one warm for the session
+        self.execution_mode = execution_mode
+        self.persistent_namespace = persistent_namespace
+        self._worker = None
+
+    def lease(self, wait: bool = True):
+        """Leases the sandbox now instead of on first use, along with its dispatcher and worker.
+
+        With `wait=False`, returns None instead of waiting when the pool has no sandbox ready.
+        """
+        with self._lease_lock:
+            if self._sandbox is not None:
+                return self._sandbox
+        # The pool may wait for a venv to be built; the lock is not held meanwhile, so release never waits on it
+        sandbox = self.pool.lease() if wait else self.pool.try_lease()
+        if sandbox is None:
+            return None
+        with self._lease_lock:
+            if self._sandbox is None and not self._closed:
+                self._sandbox = sandbox
+                self._dispatcher = ToolDispatcher(sandbox.execution_dir, max_workers=self.max_parallel_tools)
+                if self.execution_mode == "worker":
+                    self._worker = InterpreterWorker(
+                        sandbox.python_executable,
+                        sandbox.execution_dir,
+                        limits=self.limits,
+                        persistent=self.persistent_namespace,
+                    )
+                return sandbox
+            current = self._sandbox
+        # Another thread leased first, or the Coder was closed while waiting
+        self.pool.release(sandbox)
+        if current is None:
+            raise RuntimeError("Coder is closed")
+        return current
+
+    @property
+    def sandbox(self):
+        return self._sandbox or self.lease()
+
+    @property
+    def execution_dir(self) -> str:
+        return self.sandbox.execution_dir
+
+    @property
+    def dispatcher(self) -> ToolDispatcher:
+        self.lease()
+        return self._dispatcher
+
+    @property
+    def worker(self):
+        self.lease()
+        return self._worker
+
+    def prepare(self, conversation: list[dict] = None):
+        """Gets ready for a task while the conversation that leads to it is still going on.
+
+        Selects lessons for the conversation so far and, once it suggests packages, installs
+        them into a sandbox the pool already has ready; nothing waits for a venv to be built.
+        Safe to call repeatedly and from a background thread.
+        """
+        text = "\n".join(message["content"] for message in conversation or []
+                         if message["role"] != "system" and message.get("content"))
+        if not text:
+            return
+        with self._lease_lock:
+            # The session may have ended while this was queued
+            if self._closed:
+                return
+            self._preparing += 1
+        try:
+            with get_tracer().span("prepare", self.instance_id) as span:
+                if self._conversation_history is None and not self._resume:
+                    # The lessons are selected once, for what the user has asked so far
+                    self._task = self._task or text
+                    self.load_history()
+
+                requirements = suggested_requirements(text)
+                if not requirements:
+                    return
+                sandbox = self.lease(wait=False)
+                if sandbox is None:
+                    span.set(skipped="no sandbox ready")
+                    return
+                with self._install_lock:
+                    if self._closed or self._sandbox is not sandbox:
+                        return  # released meanwhile
+                    installed = self.resolver.install(sandbox, requirements)
+                span.set(packages=installed)
+        finally:
+            with self._lease_lock:
+                self._preparing -= 1
+                hand_back = self._release_pending and not self._preparing
+            if hand_back:
+                self.release()
+
+    def release(self):
+        """Returns the sandbox to the pool; scratch files are wiped, the interpreter is kept.
+
+        Never waits on a background prepare: while one runs, it hands the sandbox back when it finishes.
+        """
+        lease_lock = getattr(self, "_lease_lock", None)
+        if lease_lock is None:
+            return  # construction did not get this far
+        with lease_lock:
+            if self._preparing:
+                self._release_pending = True
+                return
+            self._release_pending = False
+            dispatcher, self._dispatcher = getattr(self, "_dispatcher", None), None
+            worker, self._worker = getattr(self, "_worker", None), None
+            sandbox, self._sandbox = self._sandbox, None
+        if dispatcher is not None:
+            dispatcher.shutdown()
+        if worker is not None:
+            worker.stop()
+        if sandbox is not None:
+            # An install by a tool call in progress finishes before its sandbox goes back to the pool
+            with self._install_lock:
+                self.pool.release(sandbox)
+
+    def close(self):
+        super().close()
+        self._closed = True
+        self.release()
 
     def __del__(self):
-        # Clean up the temporary directory when the object is destroyed
-        if os.path.exists(self.execution_dir):
-            shutil.rmtree(self.execution_dir)
-
-    def execute_code(self, code):
-        import subprocess
-        import sys
-        import os
-        import re
+        try:
+            self.release()
+        except Exception:
+            pass
+
+    def _ensure_packages(self, code):
+        # Concurrent tool calls share one venv, so installs into it are serialized
+        with self._install_lock, get_tracer().span("pip_install", self.instance_id) as span:
+            span.set(packages=self.resolver.ensure(self.sandbox, code))
+
+    def _execution_cache_key(self, code: str, workdir: str, deterministic: bool = None):
+        """Returns the execution cache key of a snippet, or None when it has to run"""
+        if self.execution_cache is None:
+            return None
+        # Caching is opt-in: per snippet, or for every snippet the cache's guess accepts
+        if deterministic is None:
+            deterministic = self.execution_cache.guess_determinism and is_deterministic(code)
+        # A persistent namespace carries state between snippets, so no result can be reused there
+        if self.persistent_namespace or not deterministic:
+            self.execution_cache.bypass()
+            return None
+        installed = set(self.sandbox.installed or ()) | set(requirements_for(code))
+        return ExecutionCache.key(code, installed, workdir, deterministic is True)
+
+    def _cached_result(self, key: str):
+        with get_tracer().span("execution_cache", self.instance_id) as span:
+            result = self.execution_cache.get(key)
+            span.set(cached=result is not None)
+        return None if result is None else ExecutionResult(**dict(result, cached=True))
+
+    def _store_result(self, key: str, result: ExecutionResult):
+        if key is not None and not result.timed_out and result.returncode >= 0:
+            self.execution_cache.put(key, dataclasses.asdict(result))
+
+    def run_code(self, code, workdir: str = None, deterministic: bool = None) -> ExecutionResult:
+        """Runs a snippet within the Coder's limits and returns the structured result.
+
+        With an execution cache, a snippet flagged `deterministic` that already ran in the same
+        environment returns its stored result. Unflagged snippets are cached only when the cache
+        guesses determinism; `deterministic=False` always runs.
+        """
+        workdir = workdir or self.execution_dir
+        key = self._execution_cache_key(code, workdir, deterministic)
+        if key is not None:
+            cached = self._cached_result(key)
+            if cached is not None:
+                return cached
+
+        # Create a temporary file to store the code in the working directory
+        code_file_path = os.path.join(workdir, "script.py")
+        with open(code_file_path, "w") as code_file:
+            code_file.write(code)
+
+        # Install missing third-party packages in one batch from the shared cache
+        self._ensure_packages(code)
+
+        if self.worker is not None:
+            # Send the code to the warm interpreter instead of starting a new one
+            with self._worker_lock, get_tracer().span("run", self.instance_id, mode="worker") as span:
+                result = self.worker.execute(code, timeout=self.timeout, cwd=workdir)
+                span.set(returncode=result.returncode, timed_out=result.timed_out)
+        else:
+            # Run the code in a subprocess with the virtual environment, output capped and limits applied
+            result = runner.run([self.sandbox.python_executable, code_file_path], workdir, self.limits, self.instance_id)
+        self._store_result(key, result)
+        return result
+
+    async def arun_code(self, code, workdir: str = None, deterministic: bool = None) -> ExecutionResult:
+        """Async variant of run_code built on asyncio subprocesses"""
+        workdir = workdir or self.execution_dir
+        key = await asyncio.to_thread(self._execution_cache_key, code, workdir, deterministic)
+        if key is not None:
+            cached = await asyncio.to_thread(self._cached_result, key)
+            if cached is not None:
+                return cached
+
+        code_file_path = os.path.join(workdir, "script.py")
+        with open(code_file_path, "w") as code_file:
+            code_file.write(code)
+
+        await asyncio.to_thread(self._ensure_packages, code)
+
+        if self.worker is not None:
+            def execute_on_worker():
+                with self._worker_lock, get_tracer().span("run", self.instance_id, mode="worker") as span:
+                    result = self.worker.execute(code, timeout=self.timeout, cwd=workdir)
+                    span.set(returncode=result.returncode, timed_out=result.timed_out)
+                    return result
+            result = await asyncio.to_thread(execute_on_worker)
+        else:
+            result = await runner.arun([self.sandbox.python_executable, code_file_path], workdir, self.limits, self.instance_id)
+        await asyncio.to_thread(self._store_result, key, result)
+        return result
 
+    def execute_code(self, code, workdir: str = None, deterministic: bool = None):
         try:
-            # Create a temporary file to store the code in the execution directory
-            code_file_path = os.path.join(self.execution_dir, "script.py")
-            with open(code_file_path, "w") as code_file:
-                code_file.write(code)
-
-            # Extract import statements to determine required packages
-            imports = re.findall(r'^\s*import (\S+)|^\s*from (\S+) import', code, re.MULTILINE)
-            packages = {imp[0] or imp[1] for imp in imports}
-
-            # Activate the virtual environment and install packages
-            pip_executable = os.path.join(self.execution_dir, 'bin', 'pip') if os.name != 'nt' else os.path.join(self.execution_dir, 'Scripts', 'pip.exe')
-            for package in packages:
-                subprocess.run([pip_executable, "install", package], check=True)
-
-            # Run the code in a subprocess with the virtual environment
-            python_executable = os.path.join(self.execution_dir, 'bin', 'python') if os.name != 'nt' else os.path.join(self.execution_dir, 'Scripts', 'python.exe')
-            result = subprocess.run(
-                [python_executable, code_file_path],
-                capture_output=True,
-                text=True,
-                cwd=self.execution_dir
-            )
+            return self.run_code(code, workdir, deterministic).text(self.timeout)
+        except Exception as e:
+            return f"Error: {e}"
 
-            # Return the output or error
-            if result.returncode == 0:
-                return result.stdout
-            else:
-                return f"Error: {result.stderr}"
+    async def aexecute_code(self, code, workdir: str = None, deterministic: bool = None):
+        """Async variant of execute_code"""
+        try:
+            return (await self.arun_code(code, workdir, deterministic)).text(self.timeout)
         except Exception as e:
             return f"Error: {e}"
 
@@ -277,35 +552,75 @@ class Coder(Agent):
         self.add_message_to_history("user", input)
         for _ in range(1024):  # Limit to 10 iterations to avoid infinite loops
 
-            response = self.openai.beta.chat.completions.parse(
+            response = self._complete(
+                self.openai.beta.chat.completions.parse,
                 model="gpt-4o",  # Replace with the model you are using, e.g., gpt-3.5-turbo
-                messages=self.conversation_history,
+                messages=self.context_manager.compact(self.conversation_history),
                 #response_format=ContextObject,
                 tools=self.tools, 
                 temperature=0.0
             )
             if response.choices[0].message.tool_calls:
 
+                code_calls = []
                 for tool_call in response.choices[0].message.tool_calls:
                     if tool_call.function.name == "exit":
+                        self._record_code_calls(code_calls, self.dispatcher.dispatch(self.execute_code, self._code_calls(code_calls)))
                         self.add_message_to_history("assistant", json.dumps( {'function': tool_call.function.name, 'arguments': tool_call.function.arguments }))
                         args = json.loads(tool_call.function.arguments)
                         return "exit", args['output']
                     elif tool_call.function.name == "execute_code":
-                        self.add_message_to_history("assistant", json.dumps( {'function': tool_call.function.name, 'arguments': tool_call.function.arguments }))
                         # arguments: "{\"code\":\"def fibonacci(n):\\n    a, b = 0, 1\\n    for _ in range(n):\\n        a, b = b, a + b\\n    return a\\n\\n# Get the 145th Fibonacci number\\nfibonacci_145 = fibonacci(145)\\nfibonacci_145\"}"
+                        code_calls.append(tool_call)
+                self._record_code_calls(code_calls, self.dispatcher.dispatch(self.execute_code, self._code_calls(code_calls)))
+
+    def _code_calls(self, tool_calls) -> list[tuple[str, str]]:
+        calls = []
+        for tool_call in tool_calls:
+            args = json.loads(tool_call.function.arguments)
+            self.logger.debug("executing code: %s", args['code'])
+            calls.append((tool_call.id, args['code']))
+        return calls
+
+    def _record_code_calls(self, tool_calls, outputs):
+        """Appends each call and its output to history in the original tool-call order"""
+        for tool_call, execution_output in zip(tool_calls, outputs):
+            self.add_message_to_history("assistant", json.dumps( {'function': tool_call.function.name, 'arguments': tool_call.function.arguments, 'tool_call_id': tool_call.id }))
+            self.add_message_to_history("user", execution_output)
+
+    async def arun(self, input = str, context: dict = None) -> tuple[str, str]:
+        # Leasing may wait for the pool's warmer, so it happens off the event loop
+        await asyncio.to_thread(self.lease)
+        await asyncio.to_thread(self.load_history)
+        await self.aadd_message_to_history("user", input)
+        for _ in range(1024):
+
+            response = await self._acomplete(
+                self.aopenai.beta.chat.completions.parse,
+                model="gpt-4o",
+                messages=self.context_manager.compact(self.conversation_history),
+                tools=self.tools,
+                temperature=0.0
+            )
+            if response.choices[0].message.tool_calls:
+
+                code_calls = []
+                for tool_call in response.choices[0].message.tool_calls:
+                    if tool_call.function.name == "exit":
+                        self._record_code_calls(code_calls, await self.dispatcher.adispatch(self.aexecute_code, self._code_calls(code_calls)))
+                        await self.aadd_message_to_history("assistant", json.dumps( {'function': tool_call.function.name, 'arguments': tool_call.function.arguments }))
                         args = json.loads(tool_call.function.arguments)
-                        self.logger.info(f"executing code: {args['code']}")
-                        execution_output = self.execute_code(args['code'])
-                        if execution_output.strip() == "":
-                            output = "No standard output was produced. We expect the code to produce a result."
-                        else:
-                            output = f" {execution_output}"
-                        self.add_message_to_history("user", execution_output)
+                        return "exit", args['output']
+                    elif tool_call.function.name == "execute_code":
+                        code_calls.append(tool_call)
+                self._record_code_calls(code_calls, await self.dispatcher.adispatch(self.aexecute_code, self._code_calls(code_calls)))
 
 class Converser(Agent):
-    def __init__(self, user_interface, prompt: str =None, instance_id=None):
+    def __init__(self, user_interface, prompt: str =None, instance_id=None, task: str = None, stream_interface=None):
         self.user_interface = user_interface;
+        # When set, replies are streamed and each text delta is passed to stream_interface as it arrives
+        self.stream_interface = stream_interface
+        self.turn_metrics = []
         prompt = """You are an intelligent assistant that interacts with users to clarify and gather specific requirements and constraints for any task the user needs help with. Your objective is to engage the user in a structured conversation to fully understand the details of their request, without making any assumptions about the task itself.
 
 Instructions:
@@ -325,8 +640,60 @@ Once all necessary information is gathered, confirm with the user that you have
 Throughout, maintain a polite and clear tone, guiding the user through each question to avoid overwhelming them.
 
     """
-        super().__init__(prompt=prompt, instance_id=instance_id, tools=[programmer_agent_tool])
-        
+        super().__init__(prompt=prompt, instance_id=instance_id, tools=[programmer_agent_tool], task=task)
+
+    def _record_turn(self, assembler: StreamAssembler, span):
+        metrics = assembler.metrics()
+        self.turn_metrics.append(metrics)
+        tracer = get_tracer()
+        tracer.record_completion(span, assembler.usage, self.agent_type)
+        tracer.observe("time_to_first_token_seconds", metrics["time_to_first_token"], agent_type=self.agent_type)
+        span.set(time_to_first_token=metrics["time_to_first_token"], tokens_per_second=metrics["tokens_per_second"])
+
+    def _stream_completion(self):
+        """Streams one reply, forwarding text deltas, and returns the assembled message"""
+        with get_tracer().span("completion", self.instance_id, agent_type=self.agent_type, model="gpt-4o", stream=True) as span:
+            return self._consume_stream(span)
+
+    def _consume_stream(self, span):
+        assembler = StreamAssembler()
+        stream = self.openai.chat.completions.create(
+            model="gpt-4o",
+            messages=self.context_manager.compact(self.conversation_history),
+            tools=self.tools,
+            temperature=0.0,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        for chunk in stream:
+            delta = assembler.feed(chunk)
+            if delta:
+                self.stream_interface(delta)
+        self._record_turn(assembler, span)
+        return assembler.message()
+
+    async def _astream_completion(self):
+        with get_tracer().span("completion", self.instance_id, agent_type=self.agent_type, model="gpt-4o", stream=True) as span:
+            return await self._aconsume_stream(span)
+
+    async def _aconsume_stream(self, span):
+        assembler = StreamAssembler()
+        stream = await self.aopenai.chat.completions.create(
+            model="gpt-4o",
+            messages=self.context_manager.compact(self.conversation_history),
+            tools=self.tools,
+            temperature=0.0,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            delta = assembler.feed(chunk)
+            if delta:
+                result = self.stream_interface(delta)
+                if inspect.isawaitable(result):
+                    await result
+        self._record_turn(assembler, span)
+        return assembler.message()
 
     def run(self, input = str, context: dict = None) -> tuple[str, str]:
         if input:
@@ -334,17 +701,22 @@ Throughout, maintain a polite and clear tone, guiding the user through each ques
 
         for k in range(1024):  # Limit iterations to avoid infinite loops
 
-            response = self.openai.chat.completions.create(
-                model="gpt-4o",  # Replace with the model you are using, e.g., gpt-3.5-turbo
-                messages=self.conversation_history,
-                tools=self.tools, 
-                temperature=0.0
-            )
+            if self.stream_interface is not None:
+                message = self._stream_completion()
+            else:
+                response = self._complete(
+                    self.openai.chat.completions.create,
+                    model="gpt-4o",  # Replace with the model you are using, e.g., gpt-3.5-turbo
+                    messages=self.context_manager.compact(self.conversation_history),
+                    tools=self.tools, 
+                    temperature=0.0
+                )
+                message = response.choices[0].message
             
 
-            if response.choices[0].message.tool_calls:
+            if message.tool_calls:
                 
-                for tool_call in response.choices[0].message.tool_calls:
+                for tool_call in message.tool_calls:
 
                     if tool_call.function.name == "programmer":
                         self.add_message_to_history("assistant", json.dumps( {'function': tool_call.function.name, 'arguments': tool_call.function.arguments }))
@@ -357,12 +729,59 @@ Throughout, maintain a polite and clear tone, guiding the user through each ques
                     else:
                         raise Exception(f"{self.instance_id} - Unknown tool call: {tool_call.function.name}")
 
-            assistant_message = response.choices[0].message.content
+            assistant_message = message.content
             
             self.add_message_to_history("assistant", assistant_message)
             
             user_input = self.user_interface(assistant_message)
             
             self.add_message_to_history("user", user_input)
+            self._notify_turn()
+
+        raise Exception("Max iterations reached")
+
+    async def arun(self, input = str, context: dict = None) -> tuple[str, str]:
+        # Reading stored messages and selecting lessons touch the database, so they run off the event loop
+        await asyncio.to_thread(self.load_history)
+        if input:
+            await self.aadd_message_to_history("user", input)
+
+        for k in range(1024):
+
+            if self.stream_interface is not None:
+                message = await self._astream_completion()
+            else:
+                response = await self._acomplete(
+                    self.aopenai.chat.completions.create,
+                    model="gpt-4o",
+                    messages=self.context_manager.compact(self.conversation_history),
+                    tools=self.tools,
+                    temperature=0.0
+                )
+                message = response.choices[0].message
+
+            if message.tool_calls:
+
+                for tool_call in message.tool_calls:
+
+                    if tool_call.function.name in ("programmer", "exit"):
+                        await self.aadd_message_to_history("assistant", json.dumps( {'function': tool_call.function.name, 'arguments': tool_call.function.arguments }))
+                        args = json.loads(tool_call.function.arguments)
+                        return tool_call.function.name, args['output']
+                    else:
+                        raise Exception(f"{self.instance_id} - Unknown tool call: {tool_call.function.name}")
+
+            assistant_message = message.content
+
+            await self.aadd_message_to_history("assistant", assistant_message)
+
+            # A blocking user_interface (e.g. input()) runs on a thread so other sessions keep going
+            if inspect.iscoroutinefunction(self.user_interface):
+                user_input = await self.user_interface(assistant_message)
+            else:
+                user_input = await asyncio.to_thread(self.user_interface, assistant_message)
+
+            await self.aadd_message_to_history("user", user_input)
+            self._notify_turn()
 
         raise Exception("Max iterations reached")
\ No newline at end of file
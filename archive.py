@@ -0,0 +1,103 @@
+import os
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 9)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This archive entry is zstd-compressed; install zstandard to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class SegmentArchive:
+    """Append-only segment files holding compressed records.
+
+    A record is written once at the end of the current segment and located afterwards by
+    (segment, position, length); the index of those locations lives with the caller. A new
+    segment starts once the current one reaches `max_segment_bytes`, or when `seal` is called.
+    The directory is created on the first write.
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._current = None
+
+    def _path(self, segment: str) -> str:
+        return os.path.join(self.directory, segment)
+
+    def segment_sizes(self) -> dict:
+        """Returns {segment name: bytes} for every segment file"""
+        if not os.path.isdir(self.directory):
+            return {}
+        return {
+            name: os.path.getsize(self._path(name))
+            for name in sorted(os.listdir(self.directory))
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        }
+
+    def _next_segment(self) -> str:
+        numbers = [int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in self.segment_sizes()]
+        return f"{SEGMENT_PREFIX}{max(numbers, default=0) + 1:06d}{SEGMENT_SUFFIX}"
+
+    def seal(self):
+        """Makes the next append start a new segment"""
+        with self._lock:
+            self._current = self._next_segment()
+
+    def append(self, data: bytes) -> tuple[str, int]:
+        """Writes a record durably and returns its (segment, position)"""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._current is None:
+                sizes = self.segment_sizes()
+                latest = max(sizes, default=None)
+                self._current = latest if latest and sizes[latest] < self.max_segment_bytes else self._next_segment()
+            elif os.path.exists(self._path(self._current)) and \
+                    os.path.getsize(self._path(self._current)) >= self.max_segment_bytes:
+                self._current = self._next_segment()
+            with open(self._path(self._current), "ab") as segment_file:
+                position = segment_file.tell()
+                segment_file.write(data)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            return self._current, position
+
+    def read(self, segment: str, position: int, length: int) -> bytes:
+        with open(self._path(segment), "rb") as segment_file:
+            segment_file.seek(position)
+            data = segment_file.read(length)
+        if len(data) != length:
+            raise IOError(f"Archive segment {segment} is truncated at {position}")
+        return data
+
+    def remove(self, segments):
+        with self._lock:
+            for segment in segments:
+                if segment == self._current:
+                    self._current = None
+                try:
+                    os.remove(self._path(segment))
+                except FileNotFoundError:
+                    pass
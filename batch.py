@@ -0,0 +1,164 @@
+"""Runs a JSONL file of tasks through the Coder, unattended, across a pool of worker processes.
+
+Each input line is a JSON object with an id (`task_id`, `request_id` or `id`) and the task
+(`task`, `prompt`, or `title` and `body`). Results are appended to the output JSONL as
+they finish; rerunning with the same output file skips the tasks already in it.
+
+    python batch.py requests.jsonl --output results.jsonl --workers 4
+"""
+import argparse
+import json
+import logging
+import multiprocessing.util
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from stats import summarize
+
+logger = logging.getLogger(__name__)
+
+# Per worker process: the sandbox pool its Coders lease from, and their settings
+_worker = {}
+
+
+def read_tasks(path: str):
+    """Yields {task_id, task} from a JSONL file, one line at a time"""
+    with open(path) as task_file:
+        for number, line in enumerate(task_file, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Ids such as 0 or "" are kept as they are, so a resumed run recognizes them
+            task_id = next((record[key] for key in ("task_id", "request_id", "id") if record.get(key) is not None),
+                           f"line-{number}")
+            task = record.get("task") or record.get("prompt")
+            if task is None:
+                task = "\n\n".join(part for part in (record.get("title"), record.get("body")) if part)
+            yield {"task_id": str(task_id), "task": task}
+
+
+def finished_task_ids(path: str, retry_errors: bool = False) -> set:
+    """Reads the ids already in an output file, so a restarted run resumes after them"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path) as result_file:
+        for line in result_file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short when the previous run was killed
+            if retry_errors and result.get("error"):
+                finished.discard(result["task_id"])
+            else:
+                finished.add(result["task_id"])
+    return finished
+
+
+def _init_worker(coder_options: dict):
+    _worker["pool"] = None
+    _worker["options"] = coder_options
+
+
+def _worker_pool():
+    """Returns the worker's sandbox pool: one sandbox, built for the first task and kept for the next ones"""
+    from sandbox import SandboxPool
+
+    if _worker["pool"] is None:
+        # Nothing is warmed ahead; the sandbox released by one task is the one the next task leases
+        _worker["pool"] = SandboxPool(size=0, max_idle=1)
+        # Worker processes end without running atexit handlers
+        multiprocessing.util.Finalize(None, _worker["pool"].shutdown, exitpriority=10)
+    return _worker["pool"]
+
+
+def run_task(task: dict) -> dict:
+    """Worker side: runs one task on a Coder and returns its result line"""
+    from agent import Coder
+
+    start = time.monotonic()
+    result = {"task_id": task["task_id"], "worker": os.getpid()}
+    coder = None
+    try:
+        coder = Coder(pool=_worker_pool(), task=task["task"], **_worker["options"])
+        result["instance_id"] = coder.instance_id
+        result["signal"], result["output"] = coder.run(task["task"])
+    except Exception as e:
+        logger.exception(f"task {task['task_id']} failed")
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if coder is not None:
+            coder.close()
+    result["latency"] = time.monotonic() - start
+    return result
+
+
+def run_batch(input_path: str, output_path: str, workers: int = 4, retry_errors: bool = False, **coder_options) -> dict:
+    """Runs every task not yet in output_path and returns a throughput and latency report"""
+    finished = finished_task_ids(output_path, retry_errors)
+    tasks = (task for task in read_tasks(input_path) if task["task_id"] not in finished)
+    latencies, errors = [], 0
+    start = time.monotonic()
+
+    with open(output_path, "a") as output, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(coder_options,)) as executor:
+
+        def record(futures):
+            nonlocal errors
+            for future in futures:
+                result = future.result()
+                output.write(json.dumps(result) + "\n")
+                latencies.append(result["latency"])
+                errors += "error" in result
+            # Each finished task is on disk before the next one is read, which makes it the checkpoint
+            output.flush()
+            logger.info(f"{len(latencies)} tasks done, {errors} failed")
+
+        # At most two tasks per worker are in flight, so the input is read as a stream
+        pending = set()
+        for task in tasks:
+            pending.add(executor.submit(run_task, task))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                record(done)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            record(done)
+
+    elapsed = time.monotonic() - start
+    return {
+        "tasks": len(latencies),
+        "skipped": len(finished),
+        "errors": errors,
+        "workers": workers,
+        "seconds": elapsed,
+        "tasks_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency": summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file of tasks")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--execution-mode", choices=("process", "worker"), default="process")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds allowed per code execution")
+    parser.add_argument("--retry-errors", action="store_true", help="run again the tasks that failed last time")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    report = run_batch(
+        args.input,
+        args.output,
+        workers=args.workers,
+        retry_errors=args.retry_errors,
+        execution_mode=args.execution_mode,
+        timeout=args.timeout,
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Offline benchmarks for the agent stack, driven against a local OpenAI stand-in.
+
+Run `python bench.py --output bench.json` and compare the JSON across versions.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_openai import MockOpenAIServer, MockScript
+from stats import summarize
+
+logger = logging.getLogger(__name__)
+
+
+def scripted_user(answers=("It is for my personal finances.", "Yes, that is everything.")):
+    """Returns a user_interface that answers from a script and records the time of each turn"""
+    turns = []
+    state = {"asked_at": None, "answer": 0}
+
+    def user_interface(text):
+        now = time.monotonic()
+        if state["asked_at"] is not None:
+            turns.append(now - state["asked_at"])
+        answer = answers[state["answer"] % len(answers)]
+        state["answer"] += 1
+        state["asked_at"] = time.monotonic()
+        return answer
+
+    user_interface.turns = turns
+    return user_interface
+
+
+def bench_sandbox(runs: int) -> dict:
+    from sandbox import Sandbox, SandboxPool
+
+    cold = []
+    for _ in range(runs):
+        start = time.monotonic()
+        Sandbox.create(os.getcwd()).destroy()
+        cold.append(time.monotonic() - start)
+
+    pool = SandboxPool(size=1, base_dir=os.getcwd())
+    pool.release(pool.lease())
+    warm = []
+    for _ in range(runs):
+        start = time.monotonic()
+        sandbox = pool.lease()
+        warm.append(time.monotonic() - start)
+        pool.release(sandbox)
+    pool.shutdown()
+    return {"cold_create": summarize(cold), "warm_lease": summarize(warm)}
+
+
+def bench_execute_code(iterations: int) -> dict:
+    from agent import Coder
+
+    results = {}
+    for mode in ("process", "worker"):
+        coder = Coder(execution_mode=mode)
+        coder.execute_code("import json")  # warm up installs and the worker
+        timings = []
+        for _ in range(iterations):
+            start = time.monotonic()
+            coder.execute_code("import json\nprint(json.dumps({'answer': 42}))")
+            timings.append(time.monotonic() - start)
+        coder.close()
+        results[mode] = summarize(timings)
+    return results
+
+
+def bench_sqlite(messages: int) -> dict:
+    from persistence import HistoryStore
+
+    store = HistoryStore(os.path.join(os.getcwd(), "bench_history.db"))
+    content = "x" * 512
+    start = time.monotonic()
+    for i in range(messages):
+        store.append(f"session-{i % 100}", "Bench", "user", content)
+    store.flush()
+    elapsed = time.monotonic() - start
+    stats = store.stats()
+    store.close()
+    return {"messages": messages, "seconds": elapsed, "messages_per_second": messages / elapsed, **stats}
+
+
+def bench_converser(sessions: int) -> dict:
+    from agent import Converser
+
+    turns, runs = [], []
+    for _ in range(sessions):
+        user = scripted_user()
+        converser = Converser(user_interface=user)
+        start = time.monotonic()
+        converser.run("I need help with a task.")
+        runs.append(time.monotonic() - start)
+        converser.close()
+        turns.extend(user.turns)
+    return {"session": summarize(runs), "turn": summarize(turns)}
+
+
+def bench_graph(sessions: int, concurrency: int) -> dict:
+    from agent import Coder, Converser
+    from runtime import CompiledGraph, Scheduler
+
+    users = []
+
+    def converser(session):
+        user = scripted_user()
+        users.append(user)
+        return Converser(user_interface=user)
+
+    definition = CompiledGraph(
+        nodes={'init': None, 'converser': converser, 'programmer': lambda session: Coder(), 'end': None},
+        transitions=[
+            ('init', 'start', 'converser'),
+            ('converser', 'programmer', 'programmer'),
+            ('programmer', 'exit', 'converser'),
+            ('converser', 'exit', 'end'),
+        ],
+        start='init',
+        speculate={'converser': ['programmer']},
+    )
+    scheduler = Scheduler(definition, max_concurrency=concurrency)
+    durations = []
+
+    async def timed(session):
+        start = time.monotonic()
+        result = await scheduler.run_session(session)
+        durations.append(time.monotonic() - start)
+        return result
+
+    async def run_all():
+        created = [scheduler.create_session(json.dumps({})) for _ in range(sessions)]
+        return await asyncio.gather(*(timed(session) for session in created), return_exceptions=True)
+
+    start = time.monotonic()
+    results = asyncio.run(run_all())
+    elapsed = time.monotonic() - start
+    errors = [repr(result) for result in results if isinstance(result, BaseException)]
+    return {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "sessions_per_second": sessions / elapsed,
+        "session": summarize(durations),
+        "turn": summarize([turn for user in users for turn in user.turns]),
+        "errors": errors[:10],
+    }
+
+
+def version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.05, help="mock completion latency in seconds")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=20, help="execute_code runs per execution mode")
+    parser.add_argument("--sandboxes", type=int, default=3, help="sandbox creations and leases to time")
+    parser.add_argument("--messages", type=int, default=10000, help="messages written in the sqlite benchmark")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    mock = MockOpenAIServer(MockScript(latency=args.latency)).start()
+    os.environ["OPENAI_BASE_URL"] = mock.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    # Databases, sandboxes and caches of the run stay in a scratch dir
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+
+    report = {
+        "version": version(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "results": {
+            "sandbox": bench_sandbox(args.sandboxes),
+            "execute_code": bench_execute_code(args.iterations),
+            "sqlite": bench_sqlite(args.messages),
+            "converser": bench_converser(args.sessions),
+            "graph": bench_graph(args.sessions, args.concurrency),
+        },
+        "mock_requests": mock.requests,
+    }
+    mock.stop()
+
+    output = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, "w") as report_file:
+            report_file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
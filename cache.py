@@ -0,0 +1,416 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from packages import find_imports
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+MODES = ("readwrite", "record", "replay")
+
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a request was never recorded"""
+
+
+class CompletionCache:
+    """A two-tier cache of chat completion responses: an in-memory LRU in front of a sqlite file.
+
+    Modes:
+        readwrite: serve hits, call the API and store on a miss
+        record: always call the API and store the response
+        replay: only serve recorded responses; a miss raises CacheMiss
+    Entries expire after `ttl` seconds (never if None), and the least recently used
+    entries are evicted once the file holds more than `max_entries`.
+    """
+
+    def __init__(self, path: str = 'completion_cache.db', mode: str = "readwrite", ttl: float = None,
+                 max_entries: int = 10000, max_memory_entries: int = 256, deterministic_only: bool = True):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cache mode {mode}, expected one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_memory_entries = max_memory_entries
+        self.deterministic_only = deterministic_only
+
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_completions_accessed_at ON completions (accessed_at)")
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(method: str, params: dict) -> str:
+        """Canonical hash of the endpoint, model, messages, tools and sampling parameters"""
+        canonical = json.dumps({"method": method, "params": params}, sort_keys=True, separators=(",", ":"), default=repr)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def cacheable(self, params: dict) -> bool:
+        return not self.deterministic_only or params.get("temperature", 1.0) == 0
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def get(self, key: str):
+        """Returns the stored response for a key, or None"""
+        with self._lock:
+            if self.mode == "record":
+                return None
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return entry[0]
+
+            row = self.connection.execute('''
+                SELECT response, created_at FROM completions WHERE key = ?
+            ''', (key,)).fetchone()
+            if row is None or self._expired(row[1]):
+                self.misses += 1
+                return None
+            with self.connection:
+                self.connection.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            response = json.loads(row[0])
+            self._remember(key, response, row[1])
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: dict):
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            with self.connection:
+                self.connection.execute('''
+                    INSERT OR REPLACE INTO completions (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)
+                ''', (key, json.dumps(response), now, now))
+                count = self.connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+                if count > self.max_entries:
+                    self.connection.execute('''
+                        DELETE FROM completions WHERE key IN (
+                            SELECT key FROM completions ORDER BY accessed_at LIMIT ?
+                        )
+                    ''', (count - self.max_entries,))
+                    self.evictions += count - self.max_entries
+
+    def _remember(self, key: str, response: dict, created_at: float):
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+            }
+
+
+def _to_completion(response: dict):
+    from openai.types.chat import ChatCompletion
+    return ChatCompletion.model_validate(response)
+
+
+def _to_chunk(chunk: dict):
+    from openai.types.chat import ChatCompletionChunk
+    return ChatCompletionChunk.model_validate(chunk)
+
+
+class _CachedMethod:
+    """Wraps one client method so its calls go through the cache"""
+
+    def __init__(self, method, name: str, cache: CompletionCache, is_async: bool):
+        self.method = method
+        self.name = name
+        self.cache = cache
+        self.is_async = is_async
+
+    def __call__(self, **params):
+        if not self.cache.cacheable(params):
+            if self.method is None:
+                raise CacheMiss(f"{self.name} call is not cacheable, so it cannot be replayed")
+            return self.method(**params)
+        key = self.cache.key(self.name, params)
+        if params.get("stream"):
+            return self._astream(key, params) if self.is_async else self._stream(key, params)
+        if self.is_async:
+            return self._acall(key, params)
+
+        response = self.cache.get(key)
+        if response is not None:
+            return _to_completion(response)
+        if self.cache.mode == "replay":
+            raise CacheMiss(f"No recorded response for {self.name} {key}")
+        completion = self.method(**params)
+        self.cache.put(key, completion.model_dump(mode="json"))
+        return completion
+
+    async def _acall(self, key: str, params: dict):
+        response = await asyncio.to_thread(self.cache.get, key)
+        if response is not None:
+            return _to_completion(response)
+        if self.cache.mode == "replay":
+            raise CacheMiss(f"No recorded response for {self.name} {key}")
+        completion = await self.method(**params)
+        await asyncio.to_thread(self.cache.put, key, completion.model_dump(mode="json"))
+        return completion
+
+    def _stream(self, key: str, params: dict):
+        """Streams are stored as their list of chunks and replayed chunk by chunk"""
+        response = self.cache.get(key)
+        if response is not None:
+            return iter([_to_chunk(chunk) for chunk in response["chunks"]])
+        if self.cache.mode == "replay":
+            raise CacheMiss(f"No recorded response for {self.name} {key}")
+        return self._record_stream(key, self.method(**params))
+
+    def _record_stream(self, key: str, stream):
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk.model_dump(mode="json"))
+            yield chunk
+        # Only a stream read to the end is stored
+        self.cache.put(key, {"chunks": chunks})
+
+    async def _astream(self, key: str, params: dict):
+        response = await asyncio.to_thread(self.cache.get, key)
+        if response is not None:
+            return _replay_chunks(response["chunks"])
+        if self.cache.mode == "replay":
+            raise CacheMiss(f"No recorded response for {self.name} {key}")
+        return self._arecord_stream(key, await self.method(**params))
+
+    async def _arecord_stream(self, key: str, stream):
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk.model_dump(mode="json"))
+            yield chunk
+        await asyncio.to_thread(self.cache.put, key, {"chunks": chunks})
+
+
+async def _replay_chunks(chunks: list[dict]):
+    for chunk in chunks:
+        yield _to_chunk(chunk)
+
+
+class CachingClient:
+    """Drop-in stand-in for OpenAI/AsyncOpenAI that serves chat completions from a CompletionCache.
+
+    In replay mode `client` may be None, so a recorded agent graph runs fully offline;
+    `asynchronous` then tells whether to behave like AsyncOpenAI.
+    """
+
+    def __init__(self, client, cache: CompletionCache, asynchronous: bool = False):
+        self.client = client
+        self.cache = cache
+        create = client.chat.completions.create if client is not None else None
+        parse = client.beta.chat.completions.parse if client is not None else None
+        if client is not None:
+            from openai import AsyncOpenAI
+            asynchronous = isinstance(client, AsyncOpenAI)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=_CachedMethod(create, "chat.completions.create", cache, asynchronous)))
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            parse=_CachedMethod(parse, "beta.chat.completions.parse", cache, asynchronous))))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+# Snippets importing these, or matching NONDETERMINISTIC_CODE, are never served from the execution cache
+NONDETERMINISTIC_MODULES = frozenset({
+    "random", "secrets", "uuid", "time", "datetime", "socket", "http", "urllib", "requests", "httpx",
+    "aiohttp", "subprocess", "threading", "multiprocessing", "asyncio", "yfinance",
+})
+# Randomness, clocks, environment, user input, URLs and writes to files or other processes
+NONDETERMINISTIC_CODE = re.compile(
+    r"#\s*nocache|\b(https?|ftp)://|\.(now|today|utcnow)\(|\.random\b|\bos\.(urandom|environ|getpid|system|remove|rename|mkdir|makedirs)|\binput\(|"
+    r"\bopen\([^)]*['\"][^'\"]*[wax+][^'\"]*['\"]|\.to_(csv|excel|json|parquet|pickle)\(|savefig\(|"
+    r"\.write(_text|_bytes)?\(|\bshutil\."
+)
+
+
+def is_deterministic(code: str) -> bool:
+    """Guesses whether a snippet prints the same thing every time it runs in the same environment"""
+    return not (find_imports(code) & NONDETERMINISTIC_MODULES or NONDETERMINISTIC_CODE.search(code))
+
+
+class ExecutionCache:
+    """A cache of execute_code results: an in-memory LRU in front of a sqlite file.
+
+    Results are keyed by the code, the packages installed in the sandbox, the files in
+    the working dir and the determinism flag. Only snippets flagged as deterministic are
+    cached, or also those guessed to be with `guess_determinism`; results that timed out
+    or were killed never are. The least recently used entries are evicted past
+    `max_entries` or `max_bytes`.
+    """
+
+    def __init__(self, path: str = 'execution_cache.db', max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024,
+                 max_memory_entries: int = 256, guess_determinism: bool = False):
+        self.path = path
+        self.guess_determinism = guess_determinism
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_memory_entries = max_memory_entries
+
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS executions (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            self.connection.execute("CREATE INDEX IF NOT EXISTS idx_executions_accessed_at ON executions (accessed_at)")
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(code: str, installed, workdir: str, deterministic: bool) -> str:
+        """Canonical hash of a snippet and the environment it runs in"""
+        files = []
+        for entry in sorted(os.scandir(workdir), key=lambda entry: entry.name):
+            if entry.name in (".calls", "script.py") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        canonical = json.dumps({
+            "code": code,
+            "installed": sorted(installed),
+            "python": sys.version,
+            "files": files,
+            "deterministic": deterministic,
+        }, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str):
+        """Returns the stored result for a key, as a dict, or None"""
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return result
+
+            row = self.connection.execute("SELECT result FROM executions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with self.connection:
+                self.connection.execute("UPDATE executions SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            result = json.loads(row[0])
+            self._remember(key, result)
+            self.hits += 1
+            return result
+
+    def put(self, key: str, result: dict):
+        payload = json.dumps(result)
+        now = time.time()
+        with self._lock:
+            self._remember(key, result)
+            with self.connection:
+                self.connection.execute('''
+                    INSERT OR REPLACE INTO executions (key, result, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)
+                ''', (key, payload, len(payload), now, now))
+                count, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM executions").fetchone()
+                evicted = []
+                for old_key, old_size in self.connection.execute("SELECT key, size FROM executions ORDER BY accessed_at"):
+                    if count <= self.max_entries and size <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    count -= 1
+                    size -= old_size
+                self.connection.executemany("DELETE FROM executions WHERE key = ?", evicted)
+                for (old_key,) in evicted:
+                    self._memory.pop(old_key, None)
+                self.evictions += len(evicted)
+
+    def bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def _remember(self, key: str, result: dict):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+            }
+
+
+_default_cache = None
+_default_execution_cache = None
+
+
+def configure_cache(path: str = 'completion_cache.db', mode: str = "readwrite", **settings) -> CompletionCache:
+    """Turns on completion caching for every agent created afterwards in this process"""
+    global _default_cache
+    _default_cache = CompletionCache(path, mode=mode, **settings)
+    get_tracer().register_collector("completion_cache", _default_cache.stats)
+    return _default_cache
+
+
+def get_default_cache():
+    """Returns the cache configured with configure_cache, or None when caching is off"""
+    return _default_cache
+
+
+def configure_execution_cache(path: str = 'execution_cache.db', **settings) -> ExecutionCache:
+    """Turns on execution result caching for every Coder created afterwards in this process"""
+    global _default_execution_cache
+    _default_execution_cache = ExecutionCache(path, **settings)
+    get_tracer().register_collector("execution_cache", _default_execution_cache.stats)
+    return _default_execution_cache
+
+
+def get_default_execution_cache():
+    """Returns the cache configured with configure_execution_cache, or None when it is off"""
+    return _default_execution_cache
@@ -0,0 +1,47 @@
+import asyncio
+import os
+import threading
+import weakref
+
+# Connection pool settings of the shared clients: keep-alive sockets are reused across agents
+HTTP_LIMITS = {"max_connections": 100, "max_keepalive_connections": 20, "keepalive_expiry": 30.0}
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncOpenAI
+
+
+def configure_clients(**limits):
+    """Changes the connection pool limits (httpx.Limits arguments) of clients created afterwards"""
+    global _client
+    with _lock:
+        HTTP_LIMITS.update(limits)
+        _client = None
+        _async_clients.clear()
+
+
+def get_client():
+    """Returns the process-wide OpenAI client, creating it on first use"""
+    global _client, _client_pid
+    with _lock:
+        # A forked worker process gets its own client rather than its parent's sockets
+        if _client is None or _client_pid != os.getpid():
+            import httpx
+            from openai import DefaultHttpxClient, OpenAI
+            _client = OpenAI(http_client=DefaultHttpxClient(limits=httpx.Limits(**HTTP_LIMITS)))
+            _client_pid = os.getpid()
+        return _client
+
+
+def get_async_client():
+    """Returns the AsyncOpenAI client of the running event loop; async connections cannot move between loops"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+            client = _async_clients[loop] = AsyncOpenAI(
+                http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(**HTTP_LIMITS)))
+        return client
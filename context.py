@@ -0,0 +1,106 @@
+import json
+import logging
+
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Context settings per agent type; agent types not listed use the ContextManager defaults
+CONTEXT_SETTINGS = {
+    "Coder": {"token_budget": 24000, "keep_last": 4, "tool_output_tokens": 400},
+    "Converser": {"token_budget": 16000, "keep_last": 12, "tool_output_tokens": 400},
+}
+
+
+def configure_context(agent_type: str, **settings):
+    """Overrides the context settings of an agent type for agents created afterwards"""
+    CONTEXT_SETTINGS.setdefault(agent_type, {}).update(settings)
+
+
+def _tool_call(message: dict):
+    """Returns the tool call recorded in an assistant message, if it is one"""
+    if message["role"] != "assistant" or not (message.get("content") or "").startswith("{"):
+        return None
+    try:
+        call = json.loads(message["content"])
+    except ValueError:
+        return None
+    return call if isinstance(call, dict) and "function" in call else None
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """Keeps the head and tail of a text that is over max_tokens"""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(1, len(text) * max_tokens // tokens // 2)
+    return f"{text[:keep]}\n[... {tokens - max_tokens} tokens truncated ...]\n{text[-keep:]}"
+
+
+class ContextManager:
+    """Bounds the prompt sent to the model on each turn.
+
+    The system prompt, the first user message (the task) and the last `keep_last`
+    exchanges are always sent verbatim. Older `execute_code` calls superseded by a
+    later one are collapsed, older tool outputs are cut to `tool_output_tokens`, and if
+    the history is still over `token_budget` the oldest messages are dropped, or
+    summarized by `summarizer` (a callable taking the dropped messages, returning text).
+    """
+
+    def __init__(self, token_budget: int = 16000, keep_last: int = 6, tool_output_tokens: int = 400, summarizer=None):
+        self.token_budget = token_budget
+        self.keep_last = keep_last
+        self.tool_output_tokens = tool_output_tokens
+        self.summarizer = summarizer
+
+    @classmethod
+    def for_agent_type(cls, agent_type: str) -> "ContextManager":
+        return cls(**CONTEXT_SETTINGS.get(agent_type, {}))
+
+    def compact(self, messages: list[dict]) -> list[dict]:
+        """Returns the messages to send; the stored history is left untouched"""
+        head = messages[:1] if messages and messages[0]["role"] == "system" else []
+        if len(messages) > len(head) and messages[len(head)]["role"] == "user":
+            head = messages[:len(head) + 1]
+        body = messages[len(head):]
+        split = max(0, len(body) - 2 * self.keep_last)
+        older, recent = body[:split], body[split:]
+
+        calls = [_tool_call(message) for message in older]
+        # Every older code version is superseded once a recent message holds a newer one
+        if any((_tool_call(message) or {}).get("function") == "execute_code" for message in recent):
+            last_code = len(older)
+        else:
+            last_code = max((i for i, call in enumerate(calls) if call and call["function"] == "execute_code"), default=None)
+
+        compacted = []
+        for i, message in enumerate(older):
+            call = calls[i]
+            previous = calls[i - 1] if i > 0 else None
+            if call and call["function"] == "execute_code" and last_code is not None and i < last_code:
+                compacted.append({"role": "assistant", "content": json.dumps(
+                    {"function": "execute_code", "arguments": "[superseded code version omitted]"})})
+            elif previous and previous["function"] == "execute_code" and message["role"] == "user":
+                compacted.append({"role": "user", "content": truncate_text(message["content"] or "", self.tool_output_tokens)})
+            else:
+                compacted.append(message)
+
+        used = sum(4 + count_tokens(message["content"] or "") for message in head + recent)
+        kept = []
+        for message in reversed(compacted):
+            tokens = 4 + count_tokens(message["content"] or "")
+            if used + tokens > self.token_budget:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+
+        dropped = compacted[:len(compacted) - len(kept)]
+        if dropped:
+            if self.summarizer is not None:
+                note = f"Summary of {len(dropped)} earlier messages: {self.summarizer(dropped)}"
+            else:
+                note = f"[{len(dropped)} earlier messages omitted to fit the context budget]"
+            kept.insert(0, {"role": "user", "content": note})
+            logger.info(f"compacted history: dropped {len(dropped)} of {len(messages)} messages")
+        return head + kept + recent
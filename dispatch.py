@@ -0,0 +1,60 @@
+import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ToolDispatcher:
+    """Runs the execute_code calls of one model turn concurrently.
+
+    A turn with a single call runs in the execution dir as before. When the model
+    emits several calls, each one gets its own working dir under `.calls/`, with
+    links to the files already in the execution dir, and at most `max_workers` run
+    at once. Results always come back in the original tool-call order.
+    """
+
+    def __init__(self, execution_dir: str, max_workers: int = 4):
+        self.execution_dir = execution_dir
+        self.max_workers = max_workers
+        self._pool = None
+
+    def workdir(self, tool_call_id: str) -> str:
+        """Creates an isolated working dir for one tool call"""
+        calls_dir = os.path.join(self.execution_dir, ".calls")
+        workdir = os.path.join(calls_dir, re.sub(r"[^\w-]", "_", tool_call_id))
+        os.makedirs(workdir, exist_ok=True)
+        for name in os.listdir(self.execution_dir):
+            if name in (".calls", "script.py") or os.path.lexists(os.path.join(workdir, name)):
+                continue
+            os.symlink(os.path.join(self.execution_dir, name), os.path.join(workdir, name))
+        return workdir
+
+    def dispatch(self, execute, calls: list[tuple[str, str]]) -> list[str]:
+        """Runs (tool_call_id, code) pairs with execute(code, workdir) and returns their outputs in order"""
+        if not calls:
+            return []
+        if len(calls) == 1:
+            return [execute(calls[0][1])]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tool-call")
+        futures = [self._pool.submit(execute, code, self.workdir(tool_call_id)) for tool_call_id, code in calls]
+        return [future.result() for future in futures]
+
+    async def adispatch(self, aexecute, calls: list[tuple[str, str]]) -> list[str]:
+        """Async variant of dispatch for a coroutine aexecute(code, workdir)"""
+        if not calls:
+            return []
+        if len(calls) == 1:
+            return [await aexecute(calls[0][1])]
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def run_call(tool_call_id, code):
+            async with semaphore:
+                return await aexecute(code, self.workdir(tool_call_id))
+
+        return list(await asyncio.gather(*(run_call(*call) for call in calls)))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
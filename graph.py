@@ -1,3 +1,8 @@
+import asyncio
+
+from tracing import get_tracer
+
+
 class Node:
     def __init__(self, object):
         self.object = object
@@ -12,6 +17,10 @@ class Node:
         """Gets the next node based on the input symbol"""
         return self.transitions.get(input_symbol, None)
 
+def _node_name(node: Node) -> str:
+    return getattr(node.object, "agent_type", None) or str(node.object)
+
+
 class Graph:
     def __init__(self):
         self.nodes = {}
@@ -37,7 +46,10 @@ class Graph:
     def process_input(self, input_symbol) -> Node:
         """Processes an input symbol and moves to the next state if possible"""
         if self.current_node:
-            next_node = self.current_node.get_next_node(input_symbol)
+            with get_tracer().span("transition", getattr(self.current_node.object, "instance_id", None),
+                                   signal=input_symbol) as span:
+                next_node = self.current_node.get_next_node(input_symbol)
+                span.set(from_node=_node_name(self.current_node), to_node=_node_name(next_node) if next_node else None)
             if next_node:
                 print(f"Transitioning from {self.current_node.object.__class__.__name__} to {next_node.object.__class__.__name__} on '{input_symbol}'")
                 self.current_node = next_node
@@ -64,6 +76,32 @@ class Graph:
             print("No current node to get context from.")
             return None
 
+    async def arun(self, signal, message, context: dict = None):
+        """Drives the state machine on an event loop until a node without an agent is reached"""
+        context = {} if context is None else context
+        try:
+            while True:
+                node = self.process_input(signal)
+                if node is None or not hasattr(node.object, "arun"):
+                    return signal, message
+                signal, message = await node.object.arun(message, context)
+        finally:
+            # The session is over: flush its messages and hand back its resources
+            for node in self.nodes.values():
+                if hasattr(node.object, "close"):
+                    node.object.close()
+
+
+async def run_sessions(sessions, max_concurrency: int = 100):
+    """Interleaves many (graph, signal, message) sessions on one event loop, at most max_concurrency at a time"""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_session(graph, signal, message):
+        async with semaphore:
+            return await graph.arun(signal, message)
+
+    return await asyncio.gather(*(run_session(*session) for session in sessions), return_exceptions=True)
+
 # Example usage
 if __name__ == "__main__":
     sm = Graph()
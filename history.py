@@ -0,0 +1,110 @@
+"""Command line access to the conversation history store.
+
+    python history.py search "pandas read_csv" --agent-type Coder --role assistant --since 2024-06-01
+    python history.py archive --older-than-days 30
+    python history.py compact --purge-older-than-days 365
+"""
+import argparse
+import json
+from datetime import datetime
+
+from persistence import HistoryStore
+
+DAY = 24 * 60 * 60
+
+
+def timestamp(value: str) -> float:
+    """Parses an ISO date or datetime, or epoch seconds"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def search(store: HistoryStore, args):
+    rows = store.search(
+        args.text,
+        agent_type=args.agent_type,
+        role=args.role,
+        since=args.since,
+        until=args.until,
+        limit=args.limit,
+        offset=args.offset,
+        any_terms=args.any,
+        raw=args.raw,
+    )
+    for message_id, instance_id, agent_type, role, content, created_at, rank in rows:
+        if args.json:
+            print(json.dumps({"id": message_id, "instance_id": instance_id, "agent_type": agent_type, "role": role,
+                              "content": content, "created_at": created_at, "rank": rank}))
+            continue
+        when = datetime.fromtimestamp(created_at).isoformat(timespec="seconds") if created_at else "-"
+        text = " ".join(content.split())
+        print(f"{message_id}\t{when}\t{instance_id}\t{agent_type}/{role}\t{text[:args.width]}")
+
+
+def archive(store: HistoryStore, args):
+    report = store.archive_sessions(args.older_than_days * DAY, include_unextracted=args.include_unextracted,
+                                    limit=args.limit)
+    print(json.dumps(report, indent=2))
+
+
+def compact(store: HistoryStore, args):
+    report = {}
+    if args.archive_older_than_days is not None:
+        report["archived"] = store.archive_sessions(args.archive_older_than_days * DAY,
+                                                    include_unextracted=args.include_unextracted)
+    if args.purge_older_than_days is not None:
+        report["purged_sessions"] = store.purge_archive(args.purge_older_than_days * DAY)
+    report.update(store.compact())
+    before, after = report["before"], report["after"]
+    report["bytes_reclaimed"] = before["database_bytes"] + before["archive_bytes"] - after["database_bytes"] - after["archive_bytes"]
+    if after["archived_live_bytes"]:
+        report["compression_ratio"] = after["archived_raw_bytes"] / after["archived_live_bytes"]
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="conversation_history.db", help="history database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = commands.add_parser("search", help="full-text search over stored messages, best match first")
+    search_parser.add_argument("text", nargs="?", help="words to match; omit to list the newest messages")
+    search_parser.add_argument("--agent-type")
+    search_parser.add_argument("--role", choices=("system", "user", "assistant", "tool"))
+    search_parser.add_argument("--since", type=timestamp, help="ISO date/datetime or epoch seconds")
+    search_parser.add_argument("--until", type=timestamp, help="ISO date/datetime or epoch seconds")
+    search_parser.add_argument("--limit", type=int, default=20)
+    search_parser.add_argument("--offset", type=int, default=0)
+    search_parser.add_argument("--any", action="store_true", help="match any of the words instead of all")
+    search_parser.add_argument("--raw", action="store_true", help="treat the text as FTS5 query syntax")
+    search_parser.add_argument("--width", type=int, default=160, help="characters of content shown per message")
+    search_parser.add_argument("--json", action="store_true", help="print one JSON object per message")
+    search_parser.set_defaults(handler=search)
+
+    archive_parser = commands.add_parser("archive", help="move inactive sessions into compressed segment files")
+    archive_parser.add_argument("--older-than-days", type=float, default=30.0,
+                                help="archive sessions with no message in this many days")
+    archive_parser.add_argument("--include-unextracted", action="store_true",
+                                help="also archive sessions lessons have not been extracted from yet")
+    archive_parser.add_argument("--limit", type=int, help="archive at most this many sessions")
+    archive_parser.set_defaults(handler=archive)
+
+    compact_parser = commands.add_parser("compact", help="reclaim space in the database and the archive, reporting sizes")
+    compact_parser.add_argument("--archive-older-than-days", type=float, help="archive inactive sessions first")
+    compact_parser.add_argument("--include-unextracted", action="store_true")
+    compact_parser.add_argument("--purge-older-than-days", type=float,
+                                help="delete archived sessions whose last message is older than this")
+    compact_parser.set_defaults(handler=compact)
+
+    args = parser.parse_args()
+    store = HistoryStore(args.db)
+    try:
+        args.handler(store, args)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 import logging
 from agent import Coder, Converser
+from tracing import configure_logging
 # Assuming you have imported the necessary classes and set up your environment
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 
 
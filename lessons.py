@@ -0,0 +1,230 @@
+import logging
+import math
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def split_text(text: str, token_budget: int) -> list[str]:
+    """Splits a text that is larger than the budget into pieces that fit"""
+    tokens = count_tokens(text)
+    if tokens <= token_budget:
+        return [text]
+    size = max(1, len(text) * token_budget // tokens)
+    return [piece for start in range(0, len(text), size) for piece in split_text(text[start:start + size], token_budget)]
+
+
+def chunk_sessions(sessions: list[list[str]], token_budget: int) -> list[list[str]]:
+    """Packs sessions into chunks of at most `token_budget` tokens.
+
+    A session is only split across chunks when it does not fit in a chunk on its own.
+    """
+    chunks, current, used = [], [], 0
+
+    def close_chunk():
+        nonlocal current, used
+        if current:
+            chunks.append(current)
+        current, used = [], 0
+
+    for session in sessions:
+        session_tokens = sum(count_tokens(message) for message in session)
+        if used + session_tokens > token_budget:
+            close_chunk()
+        for message in session:
+            for piece in split_text(message, token_budget):
+                tokens = count_tokens(piece)
+                if used + tokens > token_budget:
+                    close_chunk()
+                current.append(piece)
+                used += tokens
+    close_chunk()
+    return chunks
+
+
+def parse_lessons(text: str) -> list[str]:
+    """Splits an extraction response into individual lessons"""
+    lessons = []
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or line.endswith(":"):
+            continue
+        line = re.sub(r"^(?:[-*•]|\d+[.)])\s*", "", line).replace("**", "").strip()
+        if line:
+            lessons.append(line)
+    return lessons
+
+
+def normalize_lesson(lesson: str) -> str:
+    return re.sub(r"[\W_]+", " ", lesson.lower()).strip()
+
+
+def vectorize(text: str, buckets: int = 1 << 18) -> dict[int, float]:
+    """Embeds a text as an L2-normalized sparse vector of hashed words and character trigrams"""
+    normalized = normalize_lesson(text)
+    features = normalized.split()
+    padded = f" {normalized} "
+    features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+    counts = Counter(zlib.crc32(feature.encode()) % buckets for feature in features)
+    norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+    return {bucket: count / norm for bucket, count in counts.items()}
+
+
+def similarity(a: dict[int, float], b: dict[int, float]) -> float:
+    """Cosine similarity of two normalized sparse vectors"""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(bucket, 0.0) for bucket, value in a.items())
+
+
+class LessonIndex:
+    """Ranks the stored lessons of one agent type for injection into the system prompt.
+
+    Lessons are scored on relevance to a query, recency, and how often they were
+    extracted (`weight`) or injected (`uses`). Near-duplicates, by cosine similarity of
+    hashed n-gram vectors, are merged into the existing lesson instead of stored again.
+    """
+
+    def __init__(self, store, agent_type: str, duplicate_threshold: float = 0.8, half_life_days: float = 30.0):
+        self.store = store
+        self.agent_type = agent_type
+        self.duplicate_threshold = duplicate_threshold
+        self.half_life_days = half_life_days
+        self._vectors = {}  # (row id, lesson text) -> vector
+        self._lock = threading.Lock()
+
+    def _entries(self) -> list[tuple]:
+        """Returns (row id, lesson, vector, weight, uses, last seen) for every stored lesson"""
+        entries = []
+        with self._lock:
+            for lesson_id, text, weight, uses, last_used_at, created_at in self.store.lesson_rows(self.agent_type):
+                # Rows written before lessons were stored one by one hold several lessons each
+                for lesson in parse_lessons(text) or [text]:
+                    key = (lesson_id, lesson)
+                    if key not in self._vectors:
+                        self._vectors[key] = vectorize(lesson)
+                    entries.append((lesson_id, lesson, self._vectors[key], weight, uses, max(created_at or 0, last_used_at or 0)))
+        return entries
+
+    def merge(self, candidates: list[str]) -> tuple[list[str], list[int]]:
+        """Splits candidates into new lessons and the ids of stored lessons they duplicate"""
+        known = [(lesson_id, vector) for lesson_id, _, vector, *_ in self._entries()]
+        new, reinforced = [], []
+        for lesson in candidates:
+            vector = vectorize(lesson)
+            best_id, best = None, 0.0
+            for lesson_id, other in known:
+                score = similarity(vector, other)
+                if score > best:
+                    best_id, best = lesson_id, score
+            if best >= self.duplicate_threshold:
+                if best_id is not None and best_id not in reinforced:
+                    reinforced.append(best_id)
+                continue
+            new.append(lesson)
+            known.append((None, vector))
+        return new, reinforced
+
+    def select(self, query: str = "", k: int = 10, token_budget: int = 1000) -> list[str]:
+        """Returns the top-k lessons for a query that fit in the token budget, and records their use"""
+        query_vector = vectorize(query) if query else {}
+        now = time.time()
+        scored = []
+        for lesson_id, lesson, vector, weight, uses, last_seen in self._entries():
+            age_days = (now - last_seen) / 86400 if last_seen else self.half_life_days * 4
+            score = (similarity(query_vector, vector)
+                     + 0.25 * 0.5 ** (age_days / self.half_life_days)
+                     + 0.1 * math.log1p(weight)
+                     + 0.05 * math.log1p(uses))
+            scored.append((score, lesson_id, lesson))
+        scored.sort(key=lambda entry: entry[0], reverse=True)
+
+        selected, used_ids, spent = [], [], 0
+        for _, lesson_id, lesson in scored:
+            if len(selected) >= k:
+                break
+            tokens = count_tokens(lesson) + 1
+            if spent + tokens > token_budget:
+                continue
+            selected.append(lesson)
+            spent += tokens
+            if lesson_id not in used_ids:
+                used_ids.append(lesson_id)
+        if used_ids:
+            self.store.mark_lessons_used(used_ids)
+        return selected
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_lesson_index(store, agent_type: str) -> LessonIndex:
+    """Returns the process-wide index for an agent type, so lesson vectors are computed once"""
+    with _indexes_lock:
+        key = (store.path, agent_type)
+        if key not in _indexes:
+            _indexes[key] = LessonIndex(store, agent_type)
+        return _indexes[key]
+
+
+class LessonExtractor:
+    """Extracts lessons incrementally from the conversations of one agent type.
+
+    Only messages after the agent type's watermark are read. They are grouped by
+    session, packed into token-budgeted chunks, extracted in parallel, and the results
+    are merged into the lesson index before the watermark moves.
+
+    With a `query`, only the `max_sessions` sessions whose messages best match it in the
+    full-text index are read, whatever their age, and the watermark is left where it is.
+    """
+
+    def __init__(self, agent, token_budget: int = 6000, max_workers: int = 4, query: str = None,
+                 max_sessions: int = 20):
+        self.agent = agent
+        self.store = agent.store
+        self.token_budget = token_budget
+        self.max_workers = max_workers
+        self.query = query
+        self.max_sessions = max_sessions
+
+    def new_sessions(self) -> tuple[list[list[str]], int]:
+        """Returns the unprocessed messages grouped by session, and the highest message id read"""
+        watermark = self.store.lesson_watermark(self.agent.agent_type)
+        if self.query:
+            instance_ids = self.store.search_sessions(self.query, self.agent.agent_type, limit=self.max_sessions)
+            sessions = [[content for _, _, content in self.store.iter_history(instance_id)] for instance_id in instance_ids]
+            return sessions, watermark
+        sessions = OrderedDict()
+        for message_id, instance_id, role, content in self.store.iter_messages_for_agent_type(self.agent.agent_type, after_id=watermark):
+            sessions.setdefault(instance_id, []).append(content)
+            watermark = message_id
+        return list(sessions.values()), watermark
+
+    def merge(self, extracted: list[str]) -> tuple[list[str], list[int]]:
+        """Returns the new lessons and the ids of stored lessons that were extracted again"""
+        candidates = [lesson for response in extracted for lesson in parse_lessons(response)]
+        return get_lesson_index(self.store, self.agent.agent_type).merge(candidates)
+
+    def extract(self) -> list[str]:
+        """Extracts and stores lessons from the sessions recorded since the last run"""
+        sessions, watermark = self.new_sessions()
+        if not sessions:
+            logger.info(f"no {'matching' if self.query else 'new'} messages for agent {self.agent.agent_type}")
+            return []
+
+        chunks = chunk_sessions(sessions, self.token_budget)
+        logger.info(f"extracting lessons for agent {self.agent.agent_type} from {len(sessions)} sessions in {len(chunks)} chunks")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            extracted = list(pool.map(self.agent.extract_lessons_from_messages, chunks))
+
+        lessons, reinforced = self.merge(extracted)
+        self.store.add_lessons(self.agent.agent_type, lessons, watermark, reinforced)
+        return lessons
@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class MockScript:
+    """What the mock replies, decided from the request alone so any number of sessions can share it.
+
+    A Converser (offered the `programmer` tool) asks `converser_turns` questions and then
+    calls `programmer`, or `exit` once the programmer has answered. A Coder (offered
+    `execute_code`) runs `code` `coder_iterations` times and then calls `exit`. Any other
+    request, such as lesson extraction, gets `lessons`. Every reply waits `latency` seconds.
+    """
+
+    def __init__(self, converser_turns: int = 2, coder_iterations: int = 1, code: str = "print(42)",
+                 lessons: str = "- Print the final result on standard output.", latency: float = 0.0):
+        self.converser_turns = converser_turns
+        self.coder_iterations = coder_iterations
+        self.code = code
+        self.lessons = lessons
+        self.latency = latency
+
+    def reply(self, request: dict) -> tuple[str, list]:
+        """Returns (content, tool_calls) for a chat completion request"""
+        tools = {tool["function"]["name"] for tool in request.get("tools", [])}
+        messages = request["messages"]
+        if "execute_code" in tools:
+            runs = sum(1 for message in messages if message["role"] == "assistant" and '"execute_code"' in (message.get("content") or ""))
+            if runs < self.coder_iterations:
+                return None, [("execute_code", {"code": self.code})]
+            return None, [("exit", {"output": "42"})]
+        if "programmer" in tools:
+            if any(message["role"] == "assistant" and '"programmer"' in (message.get("content") or "") for message in messages):
+                return None, [("exit", {"output": "done"})]
+            questions = sum(1 for message in messages if message["role"] == "assistant")
+            if questions < self.converser_turns:
+                return f"Could you tell me more about detail {questions + 1} of your task?", []
+            return None, [("programmer", {"output": "Compute the answer and print it."})]
+        return self.lessons, []
+
+
+def _completion(model: str, content, tool_calls) -> dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": content,
+                "tool_calls": [
+                    {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                     "function": {"name": name, "arguments": json.dumps(arguments)}}
+                    for name, arguments in tool_calls
+                ] or None,
+            },
+            "finish_reason": "tool_calls" if tool_calls else "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len((content or "").split()) + len(tool_calls), "total_tokens": 0},
+    }
+
+
+def _chunks(completion: dict, include_usage: bool):
+    """Splits a completion into the chunks of a streamed response"""
+    message = completion["choices"][0]["message"]
+    base = {key: completion[key] for key in ("id", "created", "model")}
+    base["object"] = "chat.completion.chunk"
+
+    def chunk(delta, finish_reason=None):
+        return dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+
+    yield chunk({"role": "assistant", "content": ""})
+    for word in (message["content"] or "").split(" "):
+        yield chunk({"content": word + " "})
+    for index, call in enumerate(message["tool_calls"] or []):
+        yield chunk({"tool_calls": [dict(call, index=index)]})
+    yield chunk({}, completion["choices"][0]["finish_reason"])
+    if include_usage:
+        yield dict(base, choices=[], usage=completion["usage"])
+
+
+class MockOpenAIServer:
+    """A local stand-in for the chat completions endpoint, replaying a MockScript.
+
+    Point the OpenAI client at `base_url` (e.g. with OPENAI_BASE_URL) to use it.
+    """
+
+    def __init__(self, script: MockScript = None, host: str = "127.0.0.1", port: int = 0):
+        self.script = script or MockScript()
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.requests += 1
+                time.sleep(server.script.latency)
+                content, tool_calls = server.script.reply(request)
+                completion = _completion(request.get("model", "gpt-4o"), content, tool_calls)
+
+                if request.get("stream"):
+                    include_usage = (request.get("stream_options") or {}).get("include_usage", False)
+                    body = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in _chunks(completion, include_usage))
+                    body = (body + "data: [DONE]\n\n").encode()
+                    content_type = "text/event-stream"
+                else:
+                    body = json.dumps(completion).encode()
+                    content_type = "application/json"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        logger.info(f"mock OpenAI server listening on {self.base_url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the OpenAI chat completions API")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--converser-turns", type=int, default=2)
+    parser.add_argument("--coder-iterations", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mock = MockOpenAIServer(MockScript(args.converser_turns, args.coder_iterations, latency=args.latency), port=args.port)
+    print(f"OPENAI_BASE_URL={mock.base_url}")
+    mock.httpd.serve_forever()
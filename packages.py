@@ -0,0 +1,228 @@
+import ast
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Import names that do not match the name of the distribution that provides them
+IMPORT_TO_DISTRIBUTION = {
+    "attr": "attrs",
+    "bs4": "beautifulsoup4",
+    "cv2": "opencv-python",
+    "Crypto": "pycryptodome",
+    "dateutil": "python-dateutil",
+    "docx": "python-docx",
+    "dotenv": "python-dotenv",
+    "fitz": "pymupdf",
+    "google": "protobuf",
+    "jwt": "pyjwt",
+    "magic": "python-magic",
+    "OpenSSL": "pyopenssl",
+    "PIL": "pillow",
+    "pptx": "python-pptx",
+    "serial": "pyserial",
+    "skimage": "scikit-image",
+    "sklearn": "scikit-learn",
+    "usb": "pyusb",
+    "yaml": "pyyaml",
+}
+
+# Words that, when a conversation mentions them, suggest a package the code will likely need
+MENTION_TO_DISTRIBUTION = {
+    "numpy": "numpy",
+    "pandas": "pandas",
+    "dataframe": "pandas",
+    "scipy": "scipy",
+    "sympy": "sympy",
+    "matplotlib": "matplotlib",
+    "plot": "matplotlib",
+    "chart": "matplotlib",
+    "seaborn": "seaborn",
+    "sklearn": "scikit-learn",
+    "scikit-learn": "scikit-learn",
+    "excel": "openpyxl",
+    "xlsx": "openpyxl",
+    "requests": "requests",
+    "yaml": "pyyaml",
+}
+
+STDLIB_MODULES = frozenset(sys.stdlib_module_names) | frozenset(sys.builtin_module_names)
+
+
+def normalize(name: str) -> str:
+    """Normalizes a distribution name the way pip compares them"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def find_imports(code: str) -> set[str]:
+    """Returns the top-level module names imported by a snippet"""
+    modules = set()
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # Fall back to a line scan so a broken snippet still gets its dependencies
+        for imp in re.findall(r'^\s*import ([\w., ]+)|^\s*from (\w[\w.]*) import', code, re.MULTILINE):
+            for name in (imp[0] or imp[1]).split(","):
+                name = name.strip().split(" ")[0]
+                if name:
+                    modules.add(name.split(".")[0])
+        return modules
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.add(node.module.split(".")[0])
+    return modules
+
+
+def requirements_for(code: str) -> list[str]:
+    """Maps the third-party imports of a snippet to the distributions to install"""
+    modules = find_imports(code) - STDLIB_MODULES - {"__future__"}
+    return sorted({normalize(IMPORT_TO_DISTRIBUTION.get(module, module)) for module in modules})
+
+
+def suggested_requirements(text: str) -> list[str]:
+    """Guesses the distributions a task will need from the code and the package names in its description"""
+    suggested = set()
+    for code in re.findall(r"```(?:python|py)?\n(.*?)```", text, re.DOTALL):
+        suggested.update(requirements_for(code))
+    for word in re.findall(r"[a-z][\w-]*", text.lower()):
+        distribution = MENTION_TO_DISTRIBUTION.get(word) or MENTION_TO_DISTRIBUTION.get(word.rstrip("s"))
+        if distribution:
+            suggested.add(normalize(distribution))
+    return sorted(suggested)
+
+
+def installed_distributions(pip_executable: str) -> set[str]:
+    """Lists the distributions already present in an environment"""
+    result = subprocess.run(
+        [pip_executable, "list", "--format=json", "--disable-pip-version-check"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return set()
+    return {normalize(dist["name"]) for dist in json.loads(result.stdout)}
+
+
+class PackageCache:
+    """A local wheel cache shared by every sandbox.
+
+    Wheels are built once into a shared wheelhouse. Each requirement set is recorded
+    in a manifest named after the hash of the set, so a set that has been seen before
+    is installed straight from the wheelhouse without touching an index.
+    """
+
+    def __init__(self, cache_dir: str = None, index_url: str = None, offline: bool = False):
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".package_cache")
+        self.wheel_dir = os.path.join(self.cache_dir, "wheels")
+        self.manifest_dir = os.path.join(self.cache_dir, "sets")
+        self.index_url = index_url
+        self.offline = offline
+        os.makedirs(self.wheel_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(requirements) -> str:
+        """Returns the content address of a requirement set"""
+        canonical = "\n".join(sorted({normalize(r) for r in requirements}))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _manifest_path(self, key: str) -> str:
+        return os.path.join(self.manifest_dir, f"{key}.json")
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def has(self, requirements) -> bool:
+        return os.path.exists(self._manifest_path(self.key(requirements)))
+
+    def fetch(self, pip_executable: str, requirements):
+        """Makes sure wheels for the requirement set and its dependencies are in the wheelhouse"""
+        key = self.key(requirements)
+        with self._key_lock(key):
+            if os.path.exists(self._manifest_path(key)):
+                return
+            if self.offline:
+                raise RuntimeError(f"Requirement set {sorted(requirements)} is not in the offline package cache")
+
+            staging = tempfile.mkdtemp(dir=self.cache_dir)
+            try:
+                command = [pip_executable, "wheel", "--disable-pip-version-check", "--wheel-dir", staging,
+                           "--find-links", self.wheel_dir]
+                if self.index_url:
+                    command += ["--index-url", self.index_url]
+                subprocess.run(command + sorted(requirements), check=True, capture_output=True, text=True)
+
+                wheels = sorted(os.listdir(staging))
+                for wheel in wheels:
+                    os.replace(os.path.join(staging, wheel), os.path.join(self.wheel_dir, wheel))
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+
+            manifest_path = self._manifest_path(key)
+            with open(f"{manifest_path}.tmp", "w") as manifest:
+                json.dump({"requirements": sorted(requirements), "wheels": wheels}, manifest)
+            os.replace(f"{manifest_path}.tmp", manifest_path)
+            logger.info(f"cached requirement set {key[:12]}: {sorted(requirements)}")
+
+    def install(self, pip_executable: str, requirements):
+        """Installs a requirement set in one batched command from the wheelhouse"""
+        self.fetch(pip_executable, requirements)
+        subprocess.run(
+            [pip_executable, "install", "--disable-pip-version-check", "--no-index", "--find-links", self.wheel_dir]
+            + sorted(requirements),
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+
+
+class PackageResolver:
+    """Installs the third-party packages a snippet needs, once per environment"""
+
+    def __init__(self, cache: PackageCache = None):
+        self.cache = cache or PackageCache()
+
+    def ensure(self, sandbox, code: str) -> list[str]:
+        """Installs whatever the snippet imports that the sandbox does not have yet"""
+        return self.install(sandbox, requirements_for(code))
+
+    def install(self, sandbox, requirements: list[str]) -> list[str]:
+        """Installs the requirements the sandbox does not have yet and returns them"""
+        if sandbox.installed is None:
+            sandbox.installed = installed_distributions(sandbox.pip_executable)
+
+        missing = [r for r in requirements if r not in sandbox.installed]
+        if not missing:
+            return []
+
+        logger.info(f"installing {missing} into {sandbox.root}")
+        self.cache.install(sandbox.pip_executable, missing)
+        sandbox.installed.update(missing)
+        return missing
+
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+
+def get_default_resolver() -> PackageResolver:
+    """Returns the process-wide resolver backed by the shared package cache"""
+    global _default_resolver
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = PackageResolver()
+        return _default_resolver
@@ -0,0 +1,561 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from archive import SegmentArchive, compress, decompress, default_codec
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+# Schema migrations, applied in order. PRAGMA user_version records how many have run.
+MIGRATIONS = [
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            instance_id TEXT NOT NULL,
+            agent_type TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS lessons_learned (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent_type TEXT NOT NULL,
+            lesson TEXT NOT NULL
+        )
+        ''',
+    ],
+    [
+        "ALTER TABLE conversation_history ADD COLUMN created_at REAL",
+        "ALTER TABLE lessons_learned ADD COLUMN created_at REAL",
+        "CREATE INDEX IF NOT EXISTS idx_conversation_history_instance ON conversation_history (instance_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_conversation_history_agent_type ON conversation_history (agent_type, id)",
+        "CREATE INDEX IF NOT EXISTS idx_lessons_learned_agent_type ON lessons_learned (agent_type, id)",
+    ],
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS lesson_watermarks (
+            agent_type TEXT PRIMARY KEY,
+            last_message_id INTEGER NOT NULL
+        )
+        ''',
+    ],
+    [
+        "ALTER TABLE lessons_learned ADD COLUMN weight INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE lessons_learned ADD COLUMN uses INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE lessons_learned ADD COLUMN last_used_at REAL",
+    ],
+    [
+        # Full-text index over message content, kept in sync with the table by triggers
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversation_history_fts USING fts5 (
+            content,
+            content='conversation_history',
+            content_rowid='id',
+            tokenize='porter unicode61'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversation_history_fts_insert AFTER INSERT ON conversation_history BEGIN
+            INSERT INTO conversation_history_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversation_history_fts_delete AFTER DELETE ON conversation_history BEGIN
+            INSERT INTO conversation_history_fts (conversation_history_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS conversation_history_fts_update AFTER UPDATE OF content ON conversation_history BEGIN
+            INSERT INTO conversation_history_fts (conversation_history_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            INSERT INTO conversation_history_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''',
+        # Indexes the messages stored before this migration
+        "INSERT INTO conversation_history_fts (conversation_history_fts) VALUES ('rebuild')",
+        "CREATE INDEX IF NOT EXISTS idx_conversation_history_created_at ON conversation_history (created_at)",
+    ],
+    [
+        # Where each archived run of a session's messages lives in the segment files
+        '''
+        CREATE TABLE IF NOT EXISTS archived_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            instance_id TEXT NOT NULL,
+            agent_type TEXT NOT NULL,
+            segment TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            checksum INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            last_created_at REAL,
+            archived_at REAL NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_archived_sessions_instance ON archived_sessions (instance_id, first_id)",
+    ],
+]
+
+
+def fts_query(text: str, any_terms: bool = False) -> str:
+    """Turns free text into an FTS5 query: every word quoted, all of them required unless `any_terms`"""
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if not terms:
+        raise ValueError("Search text is empty")
+    return (" OR " if any_terms else " ").join(terms)
+
+
+class HistoryStore:
+    """Process-wide conversation store.
+
+    All agents share one sqlite connection in WAL mode. Messages are appended to an
+    in-memory queue and written behind in batches by a background thread, once
+    `batch_size` messages are pending or the oldest one has waited `flush_interval`
+    seconds. Reads flush the queue first so they always see every appended message.
+
+    `archive_sessions` moves old sessions out of the table into compressed segment files
+    under `archive_dir`; `iter_history` reads them back transparently.
+    """
+
+    def __init__(self, path: str = 'conversation_history.db', batch_size: int = 64, flush_interval: float = 0.5,
+                 archive_dir: str = None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.archive = SegmentArchive(archive_dir or os.path.splitext(path)[0] + "_archive")
+        self._archive_lock = threading.RLock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._db_lock = threading.RLock()
+        self._migrate()
+
+        self._pending = []
+        self._oldest_pending = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_latency_total = 0.0
+        self.flush_latency_max = 0.0
+        self.flush_latency_last = 0.0
+        self.max_queue_depth = 0
+
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _migrate(self):
+        """Brings the schema up to date, one migration per transaction"""
+        with self._db_lock:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+                return
+            while True:
+                # The write lock is taken before the version is read, so concurrent processes
+                # opening a fresh database apply each migration once
+                self.connection.execute("BEGIN IMMEDIATE")
+                try:
+                    version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+                    if version >= len(MIGRATIONS):
+                        self.connection.rollback()
+                        return
+                    for statement in MIGRATIONS[version]:
+                        self.connection.execute(statement)
+                    self.connection.execute(f"PRAGMA user_version = {version + 1}")
+                    self.connection.commit()
+                except sqlite3.Error:
+                    self.connection.rollback()
+                    raise
+                logger.info(f"applied migration {version + 1} to {self.path}")
+
+    def append(self, instance_id: str, agent_type: str, role: str, content: str):
+        """Queues a message for the next batched write"""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("History store is closed")
+            if not self._pending:
+                self._oldest_pending = time.monotonic()
+            self._pending.append((instance_id, agent_type, role, content, time.time()))
+            self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+    def flush(self):
+        """Writes every queued message in one transaction"""
+        # The queue is taken under the db lock, so concurrent flushes commit their batches in append order
+        with self._db_lock:
+            with self._condition:
+                rows, self._pending = self._pending, []
+                self._oldest_pending = None
+            if not rows:
+                return
+
+            start = time.monotonic()
+            instance_ids = sorted({row[0] for row in rows})
+            with get_tracer().span("db_write", instance_ids[0] if len(instance_ids) == 1 else None,
+                                   rows=len(rows), instance_ids=instance_ids):
+                try:
+                    with self.connection:
+                        self.connection.executemany('''
+                            INSERT INTO conversation_history (instance_id, agent_type, role, content, created_at)
+                                VALUES (?, ?, ?, ?, ?)
+                        ''', rows)
+                except sqlite3.Error as e:
+                    logger.error(f"failed to write {len(rows)} messages: {e}")
+                    with self._condition:
+                        self._pending[:0] = rows
+                        self._oldest_pending = self._oldest_pending or time.monotonic()
+                    raise
+            latency = time.monotonic() - start
+
+        with self._condition:
+            self.flushes += 1
+            self.rows_written += len(rows)
+            self.flush_latency_total += latency
+            self.flush_latency_max = max(self.flush_latency_max, latency)
+            self.flush_latency_last = latency
+
+    def execute(self, sql: str, parameters=()) -> list[tuple]:
+        """Runs a statement after flushing queued messages and returns all rows"""
+        self.flush()
+        with self._db_lock, self.connection:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def iter_history(self, instance_id: str, after_id: int = 0, page_size: int = 500):
+        """Yields (id, role, content) for a session in pages, starting after `after_id`.
+
+        Archived messages come first, read from their segments; then the ones still in the table.
+        """
+        for message_id, role, content, _ in self.archived_history(instance_id, after_id):
+            yield message_id, role, content
+            after_id = message_id
+        while True:
+            rows = self.execute('''
+                SELECT id, role, content FROM conversation_history
+                WHERE instance_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (instance_id, after_id, page_size))
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after_id = rows[-1][0]
+
+    def iter_messages_for_agent_type(self, agent_type: str, after_id: int = 0, page_size: int = 500):
+        """Yields (id, instance_id, role, content) for an agent type in pages, starting after `after_id`"""
+        while True:
+            rows = self.execute('''
+                SELECT id, instance_id, role, content FROM conversation_history
+                WHERE agent_type = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (agent_type, after_id, page_size))
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after_id = rows[-1][0]
+
+    def search(self, text: str = None, agent_type: str = None, role: str = None, since: float = None,
+               until: float = None, limit: int = 20, offset: int = 0, any_terms: bool = False,
+               raw: bool = False) -> list[tuple]:
+        """Returns (id, instance_id, agent_type, role, content, created_at, rank) for matching messages.
+
+        With `text`, results are ranked by bm25 (lower rank is better); without it, filters only
+        and newest first. `since`/`until` bound created_at (epoch seconds); `limit`/`offset` page.
+        `raw` passes `text` through as FTS5 query syntax instead of quoting each word.
+        """
+        conditions, parameters = [], []
+        for column, value in (("agent_type", agent_type), ("role", role)):
+            if value is not None:
+                conditions.append(f"h.{column} = ?")
+                parameters.append(value)
+        if since is not None:
+            conditions.append("h.created_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("h.created_at < ?")
+            parameters.append(until)
+
+        if text is None:
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            return self.execute(f'''
+                SELECT h.id, h.instance_id, h.agent_type, h.role, h.content, h.created_at, NULL
+                FROM conversation_history h
+                {where}
+                ORDER BY h.id DESC
+                LIMIT ? OFFSET ?
+            ''', (*parameters, limit, offset))
+
+        conditions.insert(0, "conversation_history_fts MATCH ?")
+        parameters.insert(0, text if raw else fts_query(text, any_terms))
+        return self.execute(f'''
+            SELECT h.id, h.instance_id, h.agent_type, h.role, h.content, h.created_at, f.rank
+            FROM conversation_history_fts f
+            JOIN conversation_history h ON h.id = f.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY f.rank
+            LIMIT ? OFFSET ?
+        ''', (*parameters, limit, offset))
+
+    def search_sessions(self, text: str, agent_type: str = None, limit: int = 20, any_terms: bool = True) -> list[str]:
+        """Returns the instance_ids of the sessions with messages matching `text`, best match first"""
+        parameters = [fts_query(text, any_terms)]
+        agent_filter = ""
+        if agent_type is not None:
+            agent_filter = "AND h.agent_type = ?"
+            parameters.append(agent_type)
+        rows = self.execute(f'''
+            SELECT h.instance_id, MIN(f.rank) AS best
+            FROM conversation_history_fts f
+            JOIN conversation_history h ON h.id = f.rowid
+            WHERE conversation_history_fts MATCH ? {agent_filter}
+            GROUP BY h.instance_id
+            ORDER BY best
+            LIMIT ?
+        ''', (*parameters, limit))
+        return [row[0] for row in rows]
+
+    def add_lessons(self, agent_type: str, lessons: list[str], watermark: int, reinforced: list[int] = ()):
+        """Stores extracted lessons and advances the agent type's watermark in one transaction.
+
+        `reinforced` lists the ids of stored lessons that were extracted again; their weight goes up.
+        """
+        now = time.time()
+        with self._db_lock, self.connection:
+            self.connection.executemany('''
+                INSERT INTO lessons_learned (agent_type, lesson, created_at)
+                    VALUES (?, ?, ?)
+            ''', [(agent_type, lesson, now) for lesson in lessons])
+            self.connection.executemany('''
+                UPDATE lessons_learned SET weight = weight + 1, created_at = ? WHERE id = ?
+            ''', [(now, lesson_id) for lesson_id in reinforced])
+            self.connection.execute('''
+                INSERT INTO lesson_watermarks (agent_type, last_message_id) VALUES (?, ?)
+                ON CONFLICT (agent_type) DO UPDATE SET last_message_id = excluded.last_message_id
+            ''', (agent_type, watermark))
+
+    def lesson_watermark(self, agent_type: str) -> int:
+        """Returns the id of the last message lessons were extracted from"""
+        rows = self.execute('''
+            SELECT last_message_id FROM lesson_watermarks WHERE agent_type = ?
+        ''', (agent_type,))
+        return rows[0][0] if rows else 0
+
+    def lesson_rows(self, agent_type: str, after_id: int = 0) -> list[tuple]:
+        """Returns (id, lesson, weight, uses, last_used_at, created_at) for an agent type"""
+        return self.execute('''
+            SELECT id, lesson, weight, uses, last_used_at, created_at FROM lessons_learned
+            WHERE agent_type = ? AND id > ?
+            ORDER BY id
+        ''', (agent_type, after_id))
+
+    def mark_lessons_used(self, lesson_ids: list[int]):
+        now = time.time()
+        with self._db_lock, self.connection:
+            self.connection.executemany('''
+                UPDATE lessons_learned SET uses = uses + 1, last_used_at = ? WHERE id = ?
+            ''', [(now, lesson_id) for lesson_id in lesson_ids])
+
+    def lessons(self, agent_type: str) -> list[str]:
+        rows = self.execute('''
+            SELECT lesson FROM lessons_learned
+            WHERE agent_type = ?
+            ORDER BY id
+        ''', (agent_type,))
+        return [row[0] for row in rows]
+
+    def archived_history(self, instance_id: str, after_id: int = 0) -> list[tuple]:
+        """Returns (id, role, content, created_at) for a session's archived messages after `after_id`"""
+        messages = []
+        with self._archive_lock:
+            entries = self.execute('''
+                SELECT segment, position, length, codec, checksum FROM archived_sessions
+                WHERE instance_id = ? AND last_id > ?
+                ORDER BY first_id
+            ''', (instance_id, after_id))
+            for segment, position, length, codec, checksum in entries:
+                data = self.archive.read(segment, position, length)
+                if zlib.crc32(data) != checksum:
+                    raise IOError(f"Archived session {instance_id} in {segment} at {position} is corrupt")
+                record = json.loads(decompress(data, codec))
+                messages.extend(tuple(message) for message in record["messages"] if message[0] > after_id)
+        return messages
+
+    def archive_sessions(self, older_than: float, include_unextracted: bool = False, limit: int = None) -> dict:
+        """Moves sessions with no message in the last `older_than` seconds into the segment archive.
+
+        Sessions whose messages lessons have not been extracted from yet stay in the table
+        unless `include_unextracted`, since extraction only reads the table. Archived
+        messages also leave the full-text index.
+        """
+        cutoff = time.time() - older_than
+        lesson_filter = "" if include_unextracted else "AND MAX(h.id) <= COALESCE(MAX(w.last_message_id), 0)"
+        candidates = self.execute(f'''
+            SELECT h.instance_id, MAX(h.agent_type), MAX(h.id)
+            FROM conversation_history h
+            LEFT JOIN lesson_watermarks w ON w.agent_type = h.agent_type
+            GROUP BY h.instance_id
+            HAVING COALESCE(MAX(h.created_at), 0) < ? {lesson_filter}
+            ORDER BY MAX(h.id)
+            {"LIMIT ?" if limit is not None else ""}
+        ''', (cutoff,) if limit is None else (cutoff, limit))
+
+        report = {"sessions": 0, "messages": 0, "raw_bytes": 0, "archived_bytes": 0}
+        codec = default_codec()
+        with get_tracer().span("archive", sessions=len(candidates)) as span:
+            for instance_id, agent_type, last_id in candidates:
+                rows = self.execute('''
+                    SELECT id, role, content, created_at FROM conversation_history
+                    WHERE instance_id = ? AND id <= ?
+                    ORDER BY id
+                ''', (instance_id, last_id))
+                raw = json.dumps({"instance_id": instance_id, "agent_type": agent_type, "messages": rows}).encode()
+                data = compress(raw, codec)
+                with self._archive_lock:
+                    segment, position = self.archive.append(data)
+                    with self._db_lock, self.connection:
+                        self.connection.execute('''
+                            INSERT INTO archived_sessions (instance_id, agent_type, segment, position, length, codec,
+                                checksum, messages, raw_bytes, first_id, last_id, last_created_at, archived_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', (instance_id, agent_type, segment, position, len(data), codec, zlib.crc32(data),
+                              len(rows), len(raw), rows[0][0], rows[-1][0], rows[-1][3], time.time()))
+                        self.connection.execute('''
+                            DELETE FROM conversation_history WHERE instance_id = ? AND id <= ?
+                        ''', (instance_id, last_id))
+                report["sessions"] += 1
+                report["messages"] += len(rows)
+                report["raw_bytes"] += len(raw)
+                report["archived_bytes"] += len(data)
+            span.set(**report)
+        logger.info(f"archived {report['sessions']} sessions ({report['messages']} messages) from {self.path}")
+        return report
+
+    def purge_archive(self, older_than: float) -> int:
+        """Forgets archived sessions whose last message is older than `older_than` seconds; compact reclaims the space"""
+        with self._archive_lock, self._db_lock, self.connection:
+            return self.connection.execute('''
+                DELETE FROM archived_sessions WHERE COALESCE(last_created_at, 0) < ?
+            ''', (time.time() - older_than,)).rowcount
+
+    def storage_sizes(self) -> dict:
+        """Returns the bytes used by the database files and the archive segments"""
+        database = sum(os.path.getsize(self.path + suffix) for suffix in ("", "-wal", "-shm")
+                       if os.path.exists(self.path + suffix))
+        rows = self.execute('''
+            SELECT COUNT(*), COALESCE(SUM(messages), 0), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(length), 0)
+            FROM archived_sessions
+        ''')
+        sessions, messages, raw_bytes, live_bytes = rows[0]
+        return {
+            "database_bytes": database,
+            "hot_messages": self.execute("SELECT COUNT(*) FROM conversation_history")[0][0],
+            "archive_bytes": sum(self.archive.segment_sizes().values()),
+            "archived_sessions": sessions,
+            "archived_messages": messages,
+            "archived_raw_bytes": raw_bytes,
+            "archived_live_bytes": live_bytes,
+        }
+
+    def compact(self) -> dict:
+        """Rewrites the segments holding dead records, then vacuums the database; returns sizes before and after"""
+        before = self.storage_sizes()
+        with self._archive_lock:
+            entries = self.execute("SELECT id, segment, position, length FROM archived_sessions ORDER BY segment, position")
+            live = {}
+            for _, segment, _, length in entries:
+                live[segment] = live.get(segment, 0) + length
+            stale = {segment for segment, size in self.archive.segment_sizes().items() if live.get(segment, 0) < size}
+
+            # Live records move to fresh segments; the old files go only once the index points away from them
+            if stale:
+                self.archive.seal()
+            moves = []
+            for entry_id, segment, position, length in entries:
+                if segment in stale:
+                    moves.append((*self.archive.append(self.archive.read(segment, position, length)), entry_id))
+            with self._db_lock, self.connection:
+                self.connection.executemany("UPDATE archived_sessions SET segment = ?, position = ? WHERE id = ?", moves)
+            self.archive.remove(stale)
+
+        with self._db_lock:
+            self.connection.execute("INSERT INTO conversation_history_fts (conversation_history_fts) VALUES ('optimize')")
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        after = self.storage_sizes()
+        logger.info(f"compacted {self.path}: {before['database_bytes'] + before['archive_bytes']} -> "
+                    f"{after['database_bytes'] + after['archive_bytes']} bytes")
+        return {"before": before, "after": after, "segments_rewritten": len(stale), "records_moved": len(moves)}
+
+    def stats(self) -> dict:
+        """Returns queue depth and flush latency metrics"""
+        with self._condition:
+            return {
+                "queue_depth": len(self._pending),
+                "max_queue_depth": self.max_queue_depth,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "flush_latency_avg": self.flush_latency_total / self.flushes if self.flushes else 0.0,
+                "flush_latency_max": self.flush_latency_max,
+                "flush_latency_last": self.flush_latency_last,
+            }
+
+    def close(self):
+        """Stops the writer, flushes what is left and closes the connection"""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        self.flush()
+        with self._db_lock:
+            self.connection.close()
+
+    def _due(self) -> bool:
+        if len(self._pending) >= self.batch_size:
+            return True
+        return bool(self._pending) and time.monotonic() - self._oldest_pending >= self.flush_interval
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._due():
+                    if self._pending:
+                        self._condition.wait(self.flush_interval - (time.monotonic() - self._oldest_pending))
+                    else:
+                        self._condition.wait()
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except sqlite3.Error:
+                time.sleep(self.flush_interval)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str = 'conversation_history.db') -> HistoryStore:
+    """Returns the process-wide store for a database file, creating it on first use"""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = HistoryStore(path)
+            atexit.register(_stores[path].close)
+            get_tracer().register_collector("history_store", _stores[path].stats)
+        return _stores[path]
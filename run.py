@@ -1,56 +1,61 @@
 
 
 
+import asyncio
 import json
-import time
-from agent import Agent, Converser, Coder
+from agent import Converser, Coder
 
 import logging
 
-from graph import Graph
+from runtime import CompiledGraph, Scheduler
+from tracing import configure_logging, configure_tracing
 
 
 
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; records are formatted and written on a background thread
+configure_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Spans go to traces.jsonl, metrics to http://127.0.0.1:9464/metrics
+configure_tracing("traces.jsonl", metrics_port=9464)
+
+
+
+def stream_output(delta):
+    print(f"\033[1m{delta}\033[0m", end="", flush=True)
 
 
 def user_interface(text):
-    logger.info(f"user_interface: {text}")
-    user_input = input(f"\033[1m{text}\033[0m\n")
+    # The reply has already been streamed by stream_output
+    user_input = input("\n")
     logger.info(f"user_input: {user_input}")
     return user_input
     
 
-convo = Converser(user_interface=user_interface)
-programmer = Coder()
-
-init = None
-end = None
-g = Graph()
-g.add_node(convo)
-g.add_node(programmer)
-g.add_node(init)
-g.add_node(end)
-g.add_transition(init, 'start', convo)
-g.add_transition(convo, 'programmer', programmer)
-g.add_transition(programmer, 'exit', convo)
-g.add_transition(convo, 'exit', end)
-g.set_start_node(init)
-
-message = json.dumps({})
-ctx = {}
-signal = 'start'
-while True:
-    new_node = g.process_input(signal)
-    time.sleep(1)
-    if issubclass(type(new_node.object), Agent):
-        signal, message = new_node.object.run(message, ctx)
-    else:
-        logger.info(f"New node is not an Agent: {new_node.__class__.__name__}")
+# One immutable definition; each session gets its own agents, created when it first enters a node
+definition = CompiledGraph(
+    nodes={
+        'init': None,
+        'converser': lambda session: Converser(user_interface=user_interface, stream_interface=stream_output),
+        'programmer': lambda session: Coder(),
+        'end': None,
+    },
+    transitions=[
+        ('init', 'start', 'converser'),
+        ('converser', 'programmer', 'programmer'),
+        ('programmer', 'exit', 'converser'),
+        ('converser', 'exit', 'end'),
+    ],
+    start='init',
+    # Lease, lessons and likely packages of the Coder are prepared while the Converser talks to the user
+    speculate={'converser': ['programmer']},
+)
+
+scheduler = Scheduler(definition)
+session = scheduler.create_session(json.dumps({}))
+signal, message = asyncio.run(scheduler.run_session(session))
+logger.info(f"Session ended on '{signal}': {message}")
 
 
 
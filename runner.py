@@ -0,0 +1,232 @@
+import asyncio
+import math
+import os
+import selectors
+import signal
+import subprocess
+import time
+from dataclasses import dataclass
+
+from tracing import get_tracer
+
+READ_SIZE = 65536
+
+
+@dataclass
+class ExecutionLimits:
+    """Limits for one snippet: wall-clock `timeout` and `cpu_seconds`, address space in bytes, and
+    the bytes of stdout and of stderr kept (the first and last halves; the middle is dropped)"""
+
+    timeout: float = 60.0
+    cpu_seconds: float = None
+    memory_bytes: int = None
+    output_bytes: int = 32768
+
+
+@dataclass
+class ExecutionResult:
+    returncode: int
+    stdout: str
+    stderr: str
+    duration: float = 0.0
+    spawn_duration: float = 0.0
+    timed_out: bool = False
+    stdout_truncated: bool = False
+    stderr_truncated: bool = False
+    cached: bool = False
+
+    def text(self, timeout: float = None) -> str:
+        """Renders the result the way execute_code reports it to the model"""
+        if self.timed_out:
+            message = f"Error: execution exceeded {timeout}s"
+            return message + (f"\n{self.stdout}" if self.stdout else "")
+        if self.returncode == 0:
+            return self.stdout
+        stderr = self.stderr
+        if self.returncode < 0:
+            stderr += f"\nProcess killed by {signal.Signals(-self.returncode).name}"
+        return f"Error: {stderr}"
+
+
+def _render(head: bytes, tail: bytes, total: int) -> str:
+    omitted = total - len(head) - len(tail)
+    if omitted <= 0:
+        return (head + tail).decode(errors="replace")
+    return f"{head.decode(errors='replace')}\n... [{omitted} bytes truncated] ...\n{tail.decode(errors='replace')}"
+
+
+class OutputBuffer:
+    """Keeps the first and last halves of `limit` bytes of a stream as it is read"""
+
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def feed(self, data: bytes):
+        self.total += len(data)
+        if self.limit is None:
+            self.head += data
+            return
+        room = self.limit - self.limit // 2 - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            del self.tail[:len(self.tail) - self.limit // 2]
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > len(self.head) + len(self.tail)
+
+    def text(self) -> str:
+        return _render(bytes(self.head), bytes(self.tail), self.total)
+
+
+def read_capped(file, limit: int = None) -> tuple[str, bool]:
+    """Reads a file the way OutputBuffer would have kept it, without loading the middle"""
+    total = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    if limit is None or total <= limit:
+        return file.read().decode(errors="replace"), False
+    head = file.read(limit - limit // 2)
+    file.seek(total - limit // 2)
+    tail = file.read() if limit // 2 else b""
+    return _render(head, tail, total), True
+
+
+def limit_resources(limits: ExecutionLimits):
+    """Returns a preexec_fn applying the CPU and memory rlimits, or None when there are none"""
+    if os.name != "posix" or not (limits.cpu_seconds or limits.memory_bytes):
+        return None
+
+    def apply():
+        import resource
+        if limits.cpu_seconds:
+            # SIGXCPU at the soft limit, SIGKILL a second later if it is ignored
+            cpu = math.ceil(limits.cpu_seconds)
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        if limits.memory_bytes:
+            resource.setrlimit(resource.RLIMIT_AS, (limits.memory_bytes, limits.memory_bytes))
+
+    return apply
+
+
+def kill_group(process):
+    """Kills a process started in its own session, along with anything it spawned"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run(args: list[str], cwd: str, limits: ExecutionLimits, instance_id: str = None) -> ExecutionResult:
+    """Runs a command, streaming its output into bounded buffers, and kills its process group on timeout"""
+    tracer = get_tracer()
+    stdout, stderr = OutputBuffer(limits.output_bytes), OutputBuffer(limits.output_bytes)
+    timed_out = False
+
+    with tracer.span("spawn", instance_id) as spawn_span:
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            start_new_session=True,
+            preexec_fn=limit_resources(limits),
+        )
+    started = time.monotonic()
+    deadline = started + limits.timeout if limits.timeout else None
+
+    with tracer.span("run", instance_id, mode="process") as span:
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ, stdout)
+            selector.register(process.stderr, selectors.EVENT_READ, stderr)
+            while selector.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    timed_out = True
+                    break
+                for key, _ in selector.select(remaining):
+                    data = os.read(key.fd, READ_SIZE)
+                    if data:
+                        key.data.feed(data)
+                    else:
+                        selector.unregister(key.fileobj)
+
+        try:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            process.wait(timeout=remaining)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        if timed_out:
+            kill_group(process)
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+        span.set(returncode=process.returncode, timed_out=timed_out,
+                 stdout_bytes=stdout.total, stderr_bytes=stderr.total)
+
+    return ExecutionResult(
+        returncode=process.returncode,
+        stdout=stdout.text(),
+        stderr=stderr.text(),
+        duration=time.monotonic() - started,
+        spawn_duration=spawn_span.duration,
+        timed_out=timed_out,
+        stdout_truncated=stdout.truncated,
+        stderr_truncated=stderr.truncated,
+    )
+
+
+async def arun(args: list[str], cwd: str, limits: ExecutionLimits, instance_id: str = None) -> ExecutionResult:
+    """Async variant of run built on asyncio subprocesses"""
+    tracer = get_tracer()
+    stdout, stderr = OutputBuffer(limits.output_bytes), OutputBuffer(limits.output_bytes)
+    timed_out = False
+
+    with tracer.span("spawn", instance_id) as spawn_span:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            start_new_session=True,
+            preexec_fn=limit_resources(limits),
+        )
+    started = time.monotonic()
+
+    async def pump(stream, buffer):
+        while True:
+            data = await stream.read(READ_SIZE)
+            if not data:
+                return
+            buffer.feed(data)
+
+    with tracer.span("run", instance_id, mode="process") as span:
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(pump(process.stdout, stdout), pump(process.stderr, stderr), process.wait()),
+                limits.timeout,
+            )
+        except asyncio.TimeoutError:
+            timed_out = True
+            kill_group(process)
+            await process.wait()
+        span.set(returncode=process.returncode, timed_out=timed_out,
+                 stdout_bytes=stdout.total, stderr_bytes=stderr.total)
+
+    return ExecutionResult(
+        returncode=process.returncode,
+        stdout=stdout.text(),
+        stderr=stderr.text(),
+        duration=time.monotonic() - started,
+        spawn_duration=spawn_span.duration,
+        timed_out=timed_out,
+        stdout_truncated=stdout.truncated,
+        stderr_truncated=stderr.truncated,
+    )
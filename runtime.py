@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledGraph:
+    """An immutable graph definition shared by every session.
+
+    `nodes` maps node names to agent factories, called with the Session the agent will
+    serve (None marks a node without an agent, such as the start and end states).
+    `transitions` is a list of (from_node, input_symbol, to_node) and is compiled
+    into a lookup table once, up front. `speculate` maps a node to the nodes it is
+    likely to hand over to; their agents are prepared in the background while it runs.
+    """
+
+    __slots__ = ("nodes", "transitions", "start", "speculate")
+
+    def __init__(self, nodes: dict, transitions: list[tuple[str, str, str]], start: str, speculate: dict = None):
+        for from_node, input_symbol, to_node in transitions:
+            if from_node not in nodes or to_node not in nodes:
+                raise ValueError(f"Transition {from_node!r} --{input_symbol}--> {to_node!r} uses an unknown node")
+        if start not in nodes:
+            raise ValueError(f"Unknown start node {start!r}")
+        for node, targets in (speculate or {}).items():
+            if node not in nodes or any(target not in nodes for target in targets):
+                raise ValueError(f"Speculation from {node!r} to {targets!r} uses an unknown node")
+        object.__setattr__(self, "nodes", MappingProxyType(dict(nodes)))
+        object.__setattr__(self, "transitions", MappingProxyType({
+            (from_node, input_symbol): to_node for from_node, input_symbol, to_node in transitions
+        }))
+        object.__setattr__(self, "start", start)
+        object.__setattr__(self, "speculate", MappingProxyType({
+            node: tuple(targets) for node, targets in (speculate or {}).items()
+        }))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledGraph is immutable")
+
+    def next_node(self, node: str, input_symbol: str):
+        """Returns the node reached from `node` on `input_symbol`, or None"""
+        return self.transitions.get((node, input_symbol))
+
+
+class Session:
+    """A lightweight cursor over a CompiledGraph: where one conversation is and what it carries"""
+
+    __slots__ = ("session_id", "node", "signal", "message", "context", "agents", "done", "speculating")
+
+    def __init__(self, node: str, message, signal: str = "start", context: dict = None, session_id: str = None):
+        self.session_id = session_id or str(uuid.uuid4())
+        self.node = node
+        self.signal = signal
+        self.message = message
+        self.context = {} if context is None else context
+        self.agents = {}  # node name -> agent, created the first time the session enters the node
+        self.done = False
+        self.speculating = set()  # nodes whose agents already prepare the next ones
+
+
+class Scheduler:
+    """Advances many sessions over one shared CompiledGraph.
+
+    Agents are created lazily, per session and per node, the first time a session
+    enters a node. At most `max_concurrency` sessions run at a time. When a session
+    enters a node with `speculate` targets, their agents' `prepare` runs on a small
+    thread pool after each user reply to the current agent.
+    """
+
+    def __init__(self, graph: CompiledGraph, max_concurrency: int = 100, max_preparers: int = 4):
+        self.graph = graph
+        self.max_concurrency = max_concurrency
+        self.max_preparers = max_preparers
+        self.sessions = {}
+        self._semaphore = None
+        self._preparer = None
+
+    def create_session(self, message, signal: str = "start", context: dict = None, session_id: str = None) -> Session:
+        session = Session(self.graph.start, message, signal=signal, context=context, session_id=session_id)
+        self.sessions[session.session_id] = session
+        return session
+
+    def agent_for(self, session: Session, node: str):
+        """Returns the session's agent for a node, creating it on first use"""
+        agent = session.agents.get(node)
+        if agent is None:
+            factory = self.graph.nodes[node]
+            if factory is None:
+                return None
+            agent = session.agents[node] = factory(session)
+        return agent
+
+    def _transition(self, session: Session):
+        with get_tracer().span("transition", session.session_id, signal=session.signal, from_node=session.node) as span:
+            next_node = self.graph.next_node(session.node, session.signal)
+            span.set(to_node=next_node)
+            if next_node is None:
+                logger.info(f"{session.session_id} - no transition for '{session.signal}' from {session.node}")
+                return None
+            session.node = next_node
+            agent = self.agent_for(session, next_node)
+        self._speculate(session, next_node, agent)
+        return agent
+
+    def _speculate(self, session: Session, node: str, agent):
+        """Starts preparing the agents a node is likely to hand over to"""
+        targets = [self.agent_for(session, target) for target in self.graph.speculate.get(node, ())]
+        targets = [target for target in targets if hasattr(target, "prepare")]
+        if not targets:
+            return
+        # Preparation waits for a user reply: before that there is nothing to act on
+        if agent is not None and hasattr(agent, "turn_hooks") and node not in session.speculating:
+            session.speculating.add(node)
+
+            def prepare_targets(conversation):
+                for target in targets:
+                    self._prepare(target, list(conversation))
+
+            agent.turn_hooks.append(prepare_targets)
+
+    def _prepare(self, agent, conversation):
+        if self._preparer is None:
+            self._preparer = ThreadPoolExecutor(max_workers=self.max_preparers, thread_name_prefix="prepare")
+        future = self._preparer.submit(agent.prepare, conversation)
+        future.add_done_callback(_log_prepare_error)
+
+    def step(self, session: Session) -> bool:
+        """Moves a session to its next node and runs that node's agent; returns False once it is done"""
+        agent = self._transition(session)
+        if agent is None:
+            self.end_session(session)
+            return False
+        session.signal, session.message = agent.run(session.message, session.context)
+        return True
+
+    async def astep(self, session: Session) -> bool:
+        """Async variant of step, using the agent's arun"""
+        agent = self._transition(session)
+        if agent is None:
+            await self.aend_session(session)
+            return False
+        session.signal, session.message = await agent.arun(session.message, session.context)
+        return True
+
+    def end_session(self, session: Session):
+        """Marks a session done, flushes its agents' messages and releases their resources"""
+        session.done = True
+        for agent in session.agents.values():
+            if hasattr(agent, "close"):
+                agent.close()
+        session.agents.clear()
+        self.sessions.pop(session.session_id, None)
+
+    async def aend_session(self, session: Session):
+        """Async variant of end_session; agents are closed in a thread, since closing may flush to disk or stop processes"""
+        await asyncio.to_thread(self.end_session, session)
+
+    async def run_session(self, session: Session):
+        """Advances one session until it is done; returns its last (signal, message)"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            try:
+                while await self.astep(session):
+                    pass
+            finally:
+                if not session.done:
+                    await self.aend_session(session)
+        return session.signal, session.message
+
+    def shutdown(self):
+        """Stops the background preparation threads once they finish their current work"""
+        if self._preparer is not None:
+            self._preparer.shutdown(wait=True, cancel_futures=True)
+            self._preparer = None
+
+    async def run(self, sessions: list[Session] = None) -> list:
+        """Runs the given sessions, or every pending one, concurrently on the event loop"""
+        sessions = list(self.sessions.values()) if sessions is None else sessions
+        return await asyncio.gather(*(self.run_session(session) for session in sessions), return_exceptions=True)
+
+
+def _log_prepare_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"speculative preparation failed: {future.exception()!r}")
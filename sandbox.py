@@ -0,0 +1,219 @@
+import atexit
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+from packages import installed_distributions
+from tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+
+class Sandbox:
+    """A ready-made execution environment: a virtual environment plus a scratch working dir"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.execution_dir = os.path.join(root, "work")
+        os.makedirs(self.execution_dir, exist_ok=True)
+        self.created_at = time.monotonic()
+        self.released_at = self.created_at
+        self.installed = None  # distributions present in the venv, filled in by the package resolver
+
+    @classmethod
+    def create(cls, base_dir: str = None) -> "Sandbox":
+        """Builds a new virtual environment in a fresh temporary directory"""
+        root = tempfile.mkdtemp(dir=base_dir)
+        subprocess.run([sys.executable, "-m", "venv", root], check=True)
+        sandbox = cls(root)
+        sandbox.installed = installed_distributions(sandbox.pip_executable)
+        return sandbox
+
+    @property
+    def python_executable(self) -> str:
+        if os.name == 'nt':
+            return os.path.join(self.root, 'Scripts', 'python.exe')
+        return os.path.join(self.root, 'bin', 'python')
+
+    @property
+    def pip_executable(self) -> str:
+        if os.name == 'nt':
+            return os.path.join(self.root, 'Scripts', 'pip.exe')
+        return os.path.join(self.root, 'bin', 'pip')
+
+    def reset(self):
+        """Wipes the scratch files but keeps the interpreter and installed packages"""
+        shutil.rmtree(self.execution_dir, ignore_errors=True)
+        os.makedirs(self.execution_dir, exist_ok=True)
+
+    def destroy(self):
+        """Removes the whole environment from disk"""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class SandboxPool:
+    """Keeps `size` sandboxes warmed in the background and leases them out to Coders.
+
+    Sandboxes returned with `release` are reset and kept for the next lease. Ready
+    sandboxes above `size` are evicted once they have been idle for `idle_timeout`
+    seconds, and never more than `max_idle` are kept ready at once.
+    """
+
+    def __init__(self, size: int = 2, max_idle: int = None, idle_timeout: float = 300.0, base_dir: str = None):
+        self.size = size
+        self.max_idle = max(size, max_idle if max_idle is not None else size * 2)
+        self.idle_timeout = idle_timeout
+        self.base_dir = base_dir or os.path.dirname(os.path.abspath(__file__))
+
+        self._ready = deque()
+        self._leased = set()
+        self._waiters = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self.created = 0
+        self.evicted = 0
+        self.leases = 0
+        self.lease_wait_total = 0.0
+        self.lease_wait_max = 0.0
+        self.lease_wait_last = 0.0
+
+        self._warmer = threading.Thread(target=self._warm_loop, name="sandbox-warmer", daemon=True)
+        self._warmer.start()
+
+    def lease(self, timeout: float = None) -> Sandbox:
+        """Takes a ready sandbox from the pool, waiting for the warmer if none is available"""
+        start = time.monotonic()
+        with self._condition:
+            self._waiters += 1
+            self._condition.notify_all()
+            try:
+                while not self._ready:
+                    if self._closed:
+                        raise RuntimeError("Sandbox pool is shut down")
+                    remaining = None if timeout is None else timeout - (time.monotonic() - start)
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"No sandbox available after {timeout}s")
+                    self._condition.wait(remaining)
+                sandbox = self._ready.popleft()
+            finally:
+                self._waiters -= 1
+            self._leased.add(sandbox)
+            self._condition.notify_all()
+
+            waited = time.monotonic() - start
+            self.leases += 1
+            self.lease_wait_total += waited
+            self.lease_wait_max = max(self.lease_wait_max, waited)
+            self.lease_wait_last = waited
+        logger.info(f"leased sandbox {sandbox.root} after {waited:.3f}s")
+        return sandbox
+
+    def try_lease(self) -> Sandbox:
+        """Takes a ready sandbox if there is one, or returns None without waiting or asking the warmer for more"""
+        with self._condition:
+            if not self._ready:
+                return None
+            sandbox = self._ready.popleft()
+            self._leased.add(sandbox)
+            self._condition.notify_all()
+            self.leases += 1
+            self.lease_wait_last = 0.0
+        logger.info(f"leased sandbox {sandbox.root} without waiting")
+        return sandbox
+
+    def release(self, sandbox: Sandbox):
+        """Resets a leased sandbox and returns it to the pool"""
+        with self._condition:
+            self._leased.discard(sandbox)
+            keep = not self._closed and len(self._ready) < self.max_idle
+        if not keep:
+            sandbox.destroy()
+            return
+        sandbox.reset()
+        sandbox.released_at = time.monotonic()
+        with self._condition:
+            self._ready.append(sandbox)
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """Returns pool occupancy and lease wait time metrics"""
+        with self._condition:
+            return {
+                "ready": len(self._ready),
+                "leased": len(self._leased),
+                "created": self.created,
+                "evicted": self.evicted,
+                "leases": self.leases,
+                "lease_wait_avg": self.lease_wait_total / self.leases if self.leases else 0.0,
+                "lease_wait_max": self.lease_wait_max,
+                "lease_wait_last": self.lease_wait_last,
+            }
+
+    def shutdown(self, timeout: float = 30.0):
+        """Stops the warmer and removes every sandbox that is not currently leased"""
+        with self._condition:
+            self._closed = True
+            ready = list(self._ready)
+            self._ready.clear()
+            self._condition.notify_all()
+        for sandbox in ready:
+            sandbox.destroy()
+        # A sandbox being built right now is removed by the warmer once it is done
+        if self._warmer is not threading.current_thread():
+            self._warmer.join(timeout)
+
+    def _needs_sandbox(self) -> bool:
+        return len(self._ready) < max(self.size, self._waiters)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        evicted = []
+        while len(self._ready) > self.size and now - self._ready[0].released_at > self.idle_timeout:
+            evicted.append(self._ready.popleft())
+        self.evicted += len(evicted)
+        return evicted
+
+    def _warm_loop(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._needs_sandbox():
+                    for sandbox in self._evict_idle():
+                        sandbox.destroy()
+                    self._condition.wait(self.idle_timeout)
+                if self._closed:
+                    return
+            try:
+                sandbox = Sandbox.create(self.base_dir)
+            except Exception as e:
+                logger.error(f"failed to warm sandbox: {e}")
+                time.sleep(1)
+                continue
+            with self._condition:
+                self.created += 1
+                if self._closed:
+                    sandbox.destroy()
+                    return
+                self._ready.append(sandbox)
+                self._condition.notify_all()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> SandboxPool:
+    """Returns the process-wide sandbox pool, creating it on first use"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = SandboxPool()
+            atexit.register(_default_pool.shutdown)
+            get_tracer().register_collector("sandbox_pool", _default_pool.stats)
+        return _default_pool
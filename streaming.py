@@ -0,0 +1,63 @@
+import time
+from types import SimpleNamespace
+
+
+class StreamAssembler:
+    """Assembles a streamed chat completion into a message, timing the turn as it goes.
+
+    `feed` takes each chunk and returns the text delta it carries, if any. Tool-call
+    fragments are joined by their index. `message` returns an object shaped like
+    `response.choices[0].message`, and `metrics` the turn's time-to-first-token and
+    tokens/sec.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.parts = []
+        self.tool_calls = {}
+        self.completion_tokens = None
+        self.usage = None
+        self.deltas = 0
+
+    def feed(self, chunk) -> str:
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+            self.completion_tokens = chunk.usage.completion_tokens
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        if (delta.content or delta.tool_calls) and self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+        for fragment in delta.tool_calls or []:
+            call = self.tool_calls.setdefault(fragment.index, {"id": None, "name": "", "arguments": ""})
+            call["id"] = fragment.id or call["id"]
+            if fragment.function is not None:
+                call["name"] += fragment.function.name or ""
+                call["arguments"] += fragment.function.arguments or ""
+
+        if delta.content:
+            self.deltas += 1
+            self.parts.append(delta.content)
+            return delta.content
+        return None
+
+    def message(self):
+        tool_calls = [
+            SimpleNamespace(id=call["id"], function=SimpleNamespace(name=call["name"], arguments=call["arguments"]))
+            for _, call in sorted(self.tool_calls.items())
+        ]
+        return SimpleNamespace(content="".join(self.parts) if self.parts else None, tool_calls=tool_calls or None)
+
+    def metrics(self) -> dict:
+        finished_at = time.monotonic()
+        tokens = self.completion_tokens if self.completion_tokens is not None else self.deltas
+        first_token_at = self.first_token_at or finished_at
+        generation = finished_at - first_token_at
+        return {
+            "time_to_first_token": first_token_at - self.started_at,
+            "duration": finished_at - self.started_at,
+            "completion_tokens": tokens,
+            "tokens_per_second": tokens / generation if generation > 0 else 0.0,
+        }
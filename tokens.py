@@ -0,0 +1,29 @@
+import functools
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Counts the tokens in a text, estimating 4 characters per token when tiktoken is not installed"""
+    if not text:
+        return 0
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list[dict], model: str = "gpt-4o") -> int:
+    """Counts the tokens of a chat message list, including the per-message overhead"""
+    return sum(4 + count_tokens(message.get("content") or "", model) for message in messages) + 2
@@ -0,0 +1,288 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "crafter"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Span:
+    """One timed operation. Used as a context manager; `set` adds attributes while it runs"""
+
+    __slots__ = ("tracer", "name", "instance_id", "attributes", "timestamp", "started_at", "duration")
+
+    def __init__(self, tracer: "Tracer", name: str, instance_id: str = None, attributes: dict = None):
+        self.tracer = tracer
+        self.name = name
+        self.instance_id = instance_id
+        self.attributes = attributes or {}
+        self.timestamp = None
+        self.started_at = None
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "Span":
+        self.timestamp = time.time()
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.started_at
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.finish(self)
+        return False
+
+
+class Tracer:
+    """Records spans keyed by instance_id and keeps the metrics derived from them.
+
+    Every finished span feeds a per-name duration histogram. When `path` is set, spans
+    are also queued and appended to that JSONL file by a background thread, so the hot
+    path never waits on the disk. `register_collector` adds gauges read at export time
+    from an existing `stats()` method (sandbox pool, history store, completion cache).
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._histograms = {}  # (metric, labels) -> [bucket counts..., count, sum]
+        self._counters = {}  # (metric, labels) -> value
+        self._collectors = {}  # name -> callable returning a dict of numbers
+        self.spans_dropped = 0
+
+        self._queue = None
+        self._writer = None
+        if path:
+            self._queue = queue.SimpleQueue()
+            self._writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+            self._writer.start()
+
+    def span(self, name: str, instance_id: str = None, **attributes) -> Span:
+        return Span(self, name, instance_id, attributes)
+
+    def finish(self, span: Span):
+        self.observe("span_duration_seconds", span.duration, span=span.name)
+        if self._queue is not None:
+            self._queue.put(span)
+
+    def observe(self, metric: str, value: float, **labels):
+        """Adds a value to a histogram"""
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def increment(self, metric: str, value: float = 1, **labels):
+        """Adds to a counter"""
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_collector(self, name: str, collect):
+        self._collectors[name] = collect
+
+    def record_completion(self, span: Span, usage, agent_type: str):
+        """Adds a completion's token counts to its span and to the token counters"""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        self.increment("prompt_tokens_total", prompt_tokens, agent_type=agent_type)
+        self.increment("completion_tokens_total", completion_tokens, agent_type=agent_type)
+
+    def prometheus(self) -> str:
+        """Renders every metric in the Prometheus text exposition format"""
+        lines = []
+
+        def name_of(metric):
+            return f"{METRIC_PREFIX}_{metric}"
+
+        def render_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value)}"' for key, value in pairs) + "}"
+
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            counters = dict(self._counters)
+
+        typed = set()
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric not in typed:
+                lines.append(f"# TYPE {name_of(metric)} histogram")
+                typed.add(metric)
+            for bound, count in zip(DURATION_BUCKETS, values):
+                lines.append(f"{name_of(metric)}_bucket{render_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name_of(metric)}_bucket{render_labels(labels, [('le', '+Inf')])} {values[-2]}")
+            lines.append(f"{name_of(metric)}_count{render_labels(labels)} {values[-2]}")
+            lines.append(f"{name_of(metric)}_sum{render_labels(labels)} {values[-1]}")
+
+        for (metric, labels), value in sorted(counters.items()):
+            if metric not in typed:
+                lines.append(f"# TYPE {name_of(metric)} counter")
+                typed.add(metric)
+            lines.append(f"{name_of(metric)}{render_labels(labels)} {value}")
+
+        for collector_name, collect in sorted(self._collectors.items()):
+            try:
+                stats = collect()
+            except Exception as e:
+                logger.warning(f"metrics collector {collector_name} failed: {e}")
+                continue
+            for key, value in sorted(stats.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric = name_of(f"{collector_name}_{key}")
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def flush(self, timeout: float = 5.0):
+        """Waits until every queued span has been written"""
+        if self._queue is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.put(None)
+            self._writer.join(timeout=5.0)
+            self._queue = None
+
+    def _write_loop(self):
+        with open(self.path, "a") as trace_file:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                # Drain whatever else is queued so a burst costs one write
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for item in batch:
+                    if item is None:
+                        trace_file.flush()
+                        return
+                    if isinstance(item, threading.Event):
+                        trace_file.flush()
+                        item.set()
+                        continue
+                    try:
+                        trace_file.write(json.dumps({
+                            "name": item.name,
+                            "instance_id": item.instance_id,
+                            "timestamp": item.timestamp,
+                            "duration": item.duration,
+                            **item.attributes,
+                        }, default=str) + "\n")
+                    except (TypeError, ValueError) as e:
+                        self.spans_dropped += 1
+                        logger.warning(f"dropped span {item.name}: {e}")
+                trace_file.flush()
+
+
+class MetricsServer:
+    """Serves a tracer's metrics at /metrics in the Prometheus text format"""
+
+    def __init__(self, tracer: Tracer, host: str = "127.0.0.1", port: int = 9464):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self) -> "MetricsServer":
+        self._thread.start()
+        logger.info(f"serving metrics on http://{self.httpd.server_address[0]}:{self.port}/metrics")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted, so the message is built on the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+
+_tracer = Tracer()
+_metrics_server = None
+
+
+def get_tracer() -> Tracer:
+    """Returns the process-wide tracer; it keeps metrics only until configure_tracing sets a trace file"""
+    return _tracer
+
+
+def configure_tracing(path: str = "traces.jsonl", metrics_port: int = None) -> Tracer:
+    """Writes spans to a JSONL file and optionally serves metrics, for everything traced afterwards"""
+    global _tracer, _metrics_server
+    previous, _tracer = _tracer, Tracer(path)
+    _tracer._collectors.update(previous._collectors)
+    atexit.register(_tracer.close)
+    if metrics_port is not None:
+        try:
+            _metrics_server = MetricsServer(_tracer, port=metrics_port).start()
+        except OSError as e:
+            logger.warning(f"could not serve metrics on port {metrics_port}: {e}")
+    return _tracer
+
+
+def configure_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """Routes every log record through a queue; formatting and writing happen on a listener thread"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import time
+
+from runner import ExecutionLimits, ExecutionResult, kill_group, limit_resources, read_capped
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+class InterpreterWorker:
+    """A long-lived interpreter process that executes snippets sent to it over a pipe.
+
+    Imports stay loaded between snippets, so repeated `import pandas` costs nothing after
+    the first call. Each snippet runs in a fresh namespace unless `persistent` is set.
+    The worker shares the ExecutionLimits of one-off runs: a snippet that runs past the
+    timeout gets the process group killed and the worker restarted, the memory limit
+    applies to the worker process, the CPU limit to each snippet, and output is cut to
+    its head and tail. The worker is restarted after a crash at most `max_restarts`
+    times in a row.
+    """
+
+    def __init__(self, python_executable: str, cwd: str, limits: ExecutionLimits = None,
+                 max_restarts: int = 3, persistent: bool = False):
+        self.python_executable = python_executable
+        self.cwd = cwd
+        self.limits = limits or ExecutionLimits()
+        self.max_restarts = max_restarts
+        self.persistent = persistent
+
+        self.process = None
+        self.restarts = 0
+        self.consecutive_crashes = 0
+        self._next_id = 0
+
+    @property
+    def timeout(self) -> float:
+        return self.limits.timeout
+
+    def start(self):
+        """Spawns the worker process"""
+        os.makedirs(self.cwd, exist_ok=True)
+        # CPU time adds up over the worker's life, so it is limited per snippet by serve()
+        memory_only = ExecutionLimits(timeout=None, memory_bytes=self.limits.memory_bytes)
+        self.process = subprocess.Popen(
+            [self.python_executable, "-u", WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.cwd,
+            start_new_session=True,
+            preexec_fn=limit_resources(memory_only),
+        )
+        logger.info(f"started interpreter worker {self.process.pid}")
+
+    def stop(self):
+        """Terminates the worker process and anything it spawned"""
+        if self.process is None:
+            return
+        kill_group(self.process)
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def reset(self):
+        """Drops the persistent namespace while keeping imported modules loaded"""
+        if self.alive():
+            self._request({"op": "reset"}, self.timeout)
+
+    def _request(self, request: dict, timeout: float) -> dict:
+        self._next_id += 1
+        request["id"] = self._next_id
+        self.process.stdin.write((json.dumps(request) + "\n").encode())
+        self.process.stdin.flush()
+
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            raise TimeoutError(f"Execution exceeded {timeout}s")
+        line = self.process.stdout.readline()
+        if not line:
+            raise WorkerCrashed(f"Worker exited with code {self.process.wait()}")
+        return json.loads(line)
+
+    def execute(self, code: str, timeout: float = None, cwd: str = None) -> ExecutionResult:
+        """Runs a snippet, in `cwd` if given, and returns its result"""
+        timeout = timeout or self.timeout
+        if not self.alive():
+            if self.process is not None:
+                self.restart()
+            else:
+                self.start()
+
+        start = time.monotonic()
+        try:
+            response = self._request({
+                "op": "exec",
+                "code": code,
+                "cwd": cwd or self.cwd,
+                "persistent": self.persistent,
+                "cpu_seconds": self.limits.cpu_seconds,
+                "output_bytes": self.limits.output_bytes,
+            }, timeout)
+        except TimeoutError as e:
+            logger.info(f"worker timed out, restarting: {e}")
+            self.restart()
+            return ExecutionResult(1, "", f"TimeoutError: {e}", duration=time.monotonic() - start, timed_out=True)
+        except (WorkerCrashed, BrokenPipeError) as e:
+            self.consecutive_crashes += 1
+            if self.consecutive_crashes > self.max_restarts:
+                self.stop()
+                raise WorkerCrashed(f"Worker crashed {self.consecutive_crashes} times in a row") from e
+            logger.info(f"worker crashed, restarting: {e}")
+            self.restart()
+            return ExecutionResult(1, "", f"WorkerCrashed: {e}", duration=time.monotonic() - start)
+
+        self.consecutive_crashes = 0
+        return ExecutionResult(
+            returncode=response["returncode"],
+            stdout=response["stdout"],
+            stderr=response["stderr"],
+            duration=response["duration"],
+            stdout_truncated=response["stdout_truncated"],
+            stderr_truncated=response["stderr_truncated"],
+        )
+
+
+def serve():
+    """Worker side: reads requests from stdin and writes one response line per request"""
+    import importlib
+    import resource
+    import traceback
+
+    # Keep the real stdin and stdout for the protocol and let snippets write to files instead
+    requests = os.fdopen(os.dup(0), "r")
+    protocol = os.fdopen(os.dup(1), "w")
+    # Snippets read an empty stdin, as they do in process mode, and never see request lines
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    null_stdin = open(os.devnull)
+    # Snippets should not see this repository's modules, neither on their import path nor
+    # already imported by the worker itself (runner, tracing)
+    repository = os.path.dirname(WORKER_SCRIPT)
+    if sys.path and sys.path[0] == repository:
+        sys.path.pop(0)
+    for name, module in list(sys.modules.items()):
+        if name != "__main__" and os.path.dirname(getattr(module, "__file__", None) or "") == repository:
+            del sys.modules[name]
+    namespace = {"__name__": "__main__"}
+    script_dir = None
+
+    for line in requests:
+        request = json.loads(line)
+        if request["op"] == "reset":
+            namespace = {"__name__": "__main__"}
+            protocol.write(json.dumps({"id": request["id"]}) + "\n")
+            protocol.flush()
+            continue
+
+        os.makedirs(request["cwd"], exist_ok=True)
+        os.chdir(request["cwd"])
+        # Local modules resolve against this request's working dir, like a script's own dir would
+        if script_dir in sys.path:
+            sys.path.remove(script_dir)
+        script_dir = request["cwd"]
+        sys.path.insert(0, script_dir)
+        importlib.invalidate_caches()
+
+        scope = namespace if request["persistent"] else {"__name__": "__main__"}
+        if request.get("cpu_seconds"):
+            # The limit counts from the CPU time the worker has used so far
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu = int(usage.ru_utime + usage.ru_stime + request["cpu_seconds"]) + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        sys.stdin = null_stdin
+        returncode = 0
+        start = time.monotonic()
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            saved = os.dup(1), os.dup(2)
+            os.dup2(out.fileno(), 1)
+            os.dup2(err.fileno(), 2)
+            try:
+                exec(compile(request["code"], "script.py", "exec"), scope)
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+                if e.code is not None and not isinstance(e.code, int):
+                    print(e.code, file=sys.stderr)
+            except BaseException as e:
+                returncode = 1
+                traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+                os.close(saved[0])
+                os.close(saved[1])
+
+            stdout, stdout_truncated = read_capped(out, request.get("output_bytes"))
+            stderr, stderr_truncated = read_capped(err, request.get("output_bytes"))
+            response = {
+                "id": request["id"],
+                "returncode": returncode,
+                "stdout": stdout,
+                "stderr": stderr,
+                "stdout_truncated": stdout_truncated,
+                "stderr_truncated": stderr_truncated,
+                "duration": time.monotonic() - start,
+            }
+        protocol.write(json.dumps(response) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    serve()